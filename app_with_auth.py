@@ -4,47 +4,156 @@ Authenticated Chat Room with MongoDB
 Features: User authentication, contacts, private messaging
 """
 
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from functools import wraps
 import os
 import base64
 import uuid
+import math
 from datetime import datetime
+from bson import ObjectId
 from dotenv import load_dotenv
+from werkzeug.middleware.proxy_fix import ProxyFix
+import threading
 
 # Load environment variables
 load_dotenv()
 
+from rate_limit import limiter, rate_limited, rate_limited_event, request_identity
+from static_assets import StaticAssets
+from uploads import UploadStore, UploadError
+from presence import TypingThrottle, ReadReceiptBuffer, READ_RECEIPT_FLUSH_SECONDS
+from dedup import RecentSends, PENDING, valid_client_msg_id
+from invalidation import CacheInvalidation
+
 # Import database models
 try:
-    from database import User, Message, Contact, FriendRequest, db, contacts_collection
+    from database import User, Message, DuplicateMessage, MessageSearch, MessageArchive, Room, Contact, FriendRequest, SocketSession, db
     DB_AVAILABLE = True
 except Exception as e:
     print(f"⚠️  Database not configured: {e}")
     print("📝 Please set up MongoDB Atlas and create .env file")
     DB_AVAILABLE = False
 
-# Initialize Flask app
-app = Flask(__name__, 
-            static_folder='frontend/dist/assets',
-            static_url_path='/assets')
+# Initialize Flask app (static files are served from the in-memory manifest below)
+app = Flask(__name__, static_folder=None)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-this')
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB max file size
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(__file__), 'uploads')
+app.config['ARCHIVE_INTERVAL_SECONDS'] = int(os.getenv('ARCHIVE_INTERVAL_SECONDS', '3600'))
+app.config['UPLOAD_CLEANUP_SECONDS'] = int(os.getenv('UPLOAD_CLEANUP_SECONDS', '3600'))
+# Identifies this process in socket_sessions (server.py sets one per worker)
+app.config['WORKER_ID'] = os.getenv('WORKER_ID', 'main')
+
+# Initialize Socket.IO (with several workers, emits go through the message queue
+# so a user connected to any worker receives them)
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=os.getenv('SOCKETIO_MESSAGE_QUEUE'))
 
-# Initialize Socket.IO
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Per-process caches are invalidated on every worker through the same Redis
+cache_invalidation = CacheInvalidation(os.getenv('SOCKETIO_MESSAGE_QUEUE'))
+if DB_AVAILABLE:
+    cache_invalidation.on('room_members', Room.invalidate_members)
+
+# The client address arrives in X-Forwarded-For: one hop per trusted proxy in
+# front of the app (TRUSTED_PROXY_HOPS, e.g. 1 for ngrok) plus server.py's balancer
+proxy_hops = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+if os.getenv('TRUST_PROXY_HEADERS', 'false').lower() == 'true':
+    proxy_hops += 1
+if proxy_hops:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops, x_proto=proxy_hops)
 
 # Initialize Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'index'  # Redirect to React app
 
-# Store active connections: {user_id: session_id}
+# Load the React build into memory once (precompressed, cache validators ready)
+static_assets = StaticAssets(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frontend', 'dist')).load()
+
+# Chunked uploads are streamed to disk under UPLOAD_FOLDER
+upload_store = UploadStore(app.config['UPLOAD_FOLDER'])
+
+# Connections handled by this process: {user_id: {session_id, ...}}
 active_users = {}
 
+# Set while this process hands its clients over to other workers
+draining = threading.Event()
+
+def user_channel(user_id):
+    """Socket.IO room joined by every connection of a user, on whichever worker"""
+    return f'user:{user_id}'
+
+def local_sids(user_id):
+    """This process' connections for a user"""
+    return list(active_users.get(user_id, ()))
+
+# Typing indicators (never stored) and coalesced read receipts
+typing_throttle = TypingThrottle()
+
+def send_read_receipt(reader_id, contact_id, message_id):
+    """Tell the sender how far the reader has read (latest watermark only)"""
+    socketio.emit('read_receipt', {
+        'reader_id': reader_id,
+        'message_id': message_id
+    }, to=user_channel(contact_id))
+
+read_receipts = ReadReceiptBuffer(
+    mark_read_up_to=lambda reader_id, contact_id, message_id: Message.mark_read_up_to(reader_id, contact_id, message_id),
+    on_flushed=send_read_receipt
+)
+
+# Retried sends (same client_msg_id) are answered from here when possible
+recent_sends = RecentSends()
+
+def sent_message_data(message):
+    """Ack payload (message_sent / room_message_sent) for a stored message"""
+    msg_data = {
+        'id': str(message['_id']),
+        'sender_id': message['sender'],
+        'sender_name': current_user.username,
+        'content': message['content'],
+        'type': message.get('type', 'text'),
+        'timestamp': message['timestamp'].isoformat(),
+        'is_mine': True
+    }
+    if 'room' in message:
+        msg_data['room_id'] = message['room']
+    else:
+        msg_data['recipient_id'] = message['recipient']
+    if message.get('client_msg_id'):
+        msg_data['client_msg_id'] = message['client_msg_id']
+    return msg_data
+
+def replay_send(client_msg_id, ack_event):
+    """
+    True if a send was fully handled by the dedup window: an invalid ID, a
+    retry whose first attempt is still in flight, or a retry of a stored
+    message (its original ack is sent again, nothing is written or fanned out)
+    """
+    if client_msg_id is None:
+        return False
+    if not valid_client_msg_id(client_msg_id):
+        emit('error', {'message': 'Invalid client_msg_id'})
+        return True
+    
+    previous = recent_sends.claim(current_user.id, client_msg_id)
+    if previous is None:
+        return False
+    if previous is not PENDING:
+        emit(ack_event, previous)
+    return True
+
+# Group rooms
+ROOM_NAME_MAX_LENGTH = 50
+ROOM_HISTORY_LIMIT = 50
+ROOM_MAX_INITIAL_MEMBERS = 100  # More can be added one at a time
+
+def room_channel(room_id):
+    """Socket.IO room name used for fan-out to a group room"""
+    return f'room:{room_id}'
+
 # Flask-Login user loader
 class AuthUser(UserMixin):
     def __init__(self, user_data):
@@ -62,10 +171,17 @@ def load_user(user_id):
     return None
 
 # Routes
+def serve_index():
+    """Serve index.html from the static manifest"""
+    asset = static_assets.get('index.html')
+    if not asset:
+        return jsonify({'error': 'Frontend not built'}), 404
+    return static_assets.serve(asset, request)
+
 @app.route('/')
 def index():
     """Serve React app"""
-    return send_from_directory('frontend/dist', 'index.html')
+    return serve_index()
 
 @app.route('/<path:path>')
 def serve_react(path):
@@ -73,18 +189,23 @@ def serve_react(path):
     if path.startswith('api/') or path.startswith('socket.io/'):
         return jsonify({'error': 'Not found'}), 404
     
-    # Check if file exists in dist folder
-    file_path = os.path.join('frontend/dist', path)
-    if os.path.exists(file_path) and os.path.isfile(file_path):
-        return send_from_directory('frontend/dist', path)
+    # Files from the build are answered from memory (no filesystem calls)
+    asset = static_assets.get(path)
+    if asset:
+        return static_assets.serve(asset, request)
+    
+    # Missing hashed assets are real 404s, not the app shell
+    if path.startswith('assets/'):
+        return jsonify({'error': 'Not found'}), 404
     
     # Otherwise serve index.html (for React Router)
-    return send_from_directory('frontend/dist', 'index.html')
+    return serve_index()
 
 # Old template routes removed - React handles all routing
 
 # Authentication API
 @app.route('/api/signup', methods=['POST'])
+@rate_limited('signup', by='ip')
 def signup():
     """Create new user account"""
     if not DB_AVAILABLE:
@@ -111,6 +232,7 @@ def signup():
     return jsonify({'message': 'Account created successfully'}), 201
 
 @app.route('/api/login', methods=['POST'])
+@rate_limited('login', by='ip')
 def login():
     """Authenticate user"""
     if not DB_AVAILABLE:
@@ -120,9 +242,18 @@ def login():
     username = data.get('username')
     password = data.get('password')
     
-    if not username or not password:
+    if not isinstance(username, str) or not isinstance(password, str) or not username or not password:
         return jsonify({'error': 'Username and password required'}), 400
     
+    # Per-account limit is checked before any bcrypt work. It is keyed on the
+    # client too, so guesses from elsewhere can't lock the owner out; guessing
+    # one account from many IPs is left to the per-IP limit
+    allowed, retry_after = limiter.allow('login_username', f"{username.lower()}@{request_identity('ip')}")
+    if not allowed:
+        response = jsonify({'error': 'Too many login attempts, try again later'})
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response, 429
+    
     # Authenticate
     user_data = User.authenticate(username, password)
     
@@ -150,17 +281,36 @@ def logout():
 
 # Contact API
 @app.route('/api/contacts', methods=['GET'])
+@rate_limited('contacts')
 @login_required
 def get_contacts():
     """Get user's contact list"""
     if not DB_AVAILABLE:
         return jsonify({'error': 'Database not configured'}), 500
     
-    contacts = Contact.get_contacts(current_user.id)
-    return jsonify({'contacts': contacts}), 200
+    snapshot = Contact.get_snapshot(current_user.id)
+    return jsonify({'contacts': snapshot['contacts'], 'version': snapshot['version']}), 200
+
+@app.route('/api/contacts/sync', methods=['GET'])
+@rate_limited('contacts')
+@login_required
+def sync_contacts():
+    """Contacts added/removed/changed since a version (full snapshot if too old)"""
+    if not DB_AVAILABLE:
+        return jsonify({'error': 'Database not configured'}), 500
+    
+    try:
+        since_version = int(request.args.get('since_version', 0))
+    except ValueError:
+        return jsonify({'error': 'Invalid since_version'}), 400
+    
+    if since_version <= 0:
+        return jsonify(Contact.get_snapshot(current_user.id)), 200
+    return jsonify(Contact.get_changes(current_user.id, since_version)), 200
 
 # Username search/autocomplete
 @app.route('/api/users/search', methods=['GET'])
+@rate_limited('user_search')
 @login_required
 def search_users():
     """Search users by username (for autocomplete)"""
@@ -188,6 +338,7 @@ def search_users():
 
 # Friend Request APIs
 @app.route('/api/friend-requests/send', methods=['POST'])
+@rate_limited('friend_request')
 @login_required
 def send_friend_request():
     """Send a friend request"""
@@ -206,13 +357,10 @@ def send_friend_request():
         return jsonify({'error': error}), 400
     
     # Notify recipient via WebSocket
-    recipient_user = User.get_by_username(recipient_username)
-    if recipient_user and str(recipient_user['_id']) in active_users:
-        recipient_sid = active_users[str(recipient_user['_id'])]
-        socketio.emit('friend_request_received', {
-            'sender_username': current_user.username,
-            'sender_id': current_user.id
-        }, room=recipient_sid)
+    socketio.emit('friend_request_received', {
+        'sender_username': current_user.username,
+        'sender_id': current_user.id
+    }, to=user_channel(request_data['recipient_id']))
     
     return jsonify({'message': 'Friend request sent', 'request': {
         'id': str(request_data['_id']),
@@ -220,6 +368,7 @@ def send_friend_request():
     }}), 200
 
 @app.route('/api/friend-requests/pending', methods=['GET'])
+@rate_limited('contacts')
 @login_required
 def get_pending_requests():
     """Get pending friend requests"""
@@ -230,6 +379,7 @@ def get_pending_requests():
     return jsonify({'requests': requests}), 200
 
 @app.route('/api/friend-requests/accept', methods=['POST'])
+@rate_limited('friend_request')
 @login_required
 def accept_friend_request():
     """Accept a friend request"""
@@ -242,36 +392,35 @@ def accept_friend_request():
     if not request_id:
         return jsonify({'error': 'Request ID required'}), 400
     
-    success = FriendRequest.accept(request_id, current_user.id)
+    accepted = FriendRequest.accept(request_id, current_user.id)
     
-    if not success:
+    if not accepted:
         return jsonify({'error': 'Request not found'}), 404
     
-    # Get the request to find sender
-    from bson import ObjectId
-    req = db['friend_requests'].find_one({'_id': ObjectId(request_id)})
-    sender = User.get_by_id(req['sender_id'])
+    sender_id = accepted['request']['sender_id']
     
     # Notify sender via WebSocket
-    if sender and req['sender_id'] in active_users:
-        sender_sid = active_users[req['sender_id']]
-        socketio.emit('friend_request_accepted', {
-            'accepter_username': current_user.username,
-            'accepter_id': current_user.id
-        }, room=sender_sid)
-    
-    # Send updated contacts to both users
-    if current_user.id in active_users:
-        contacts = Contact.get_contacts(current_user.id)
-        socketio.emit('contacts_updated', {'contacts': contacts}, room=active_users[current_user.id])
-    
-    if req['sender_id'] in active_users:
-        sender_contacts = Contact.get_contacts(req['sender_id'])
-        socketio.emit('contacts_updated', {'contacts': sender_contacts}, room=active_users[req['sender_id']])
+    socketio.emit('friend_request_accepted', {
+        'accepter_username': current_user.username,
+        'accepter_id': current_user.id
+    }, to=user_channel(sender_id))
+    
+    # Send just the new entry to each side (not the whole list)
+    for owner_id, entry in ((sender_id, accepted['sender']), (current_user.id, accepted['recipient'])):
+        if entry:
+            socketio.emit('contact_added', {
+                'contact': {
+                    'id': entry['contact_id'],
+                    'username': entry['contact_username'],
+                    'online': entry['online']
+                },
+                'version': entry['version']
+            }, to=user_channel(owner_id))
     
     return jsonify({'message': 'Friend request accepted'}), 200
 
 @app.route('/api/friend-requests/reject', methods=['POST'])
+@rate_limited('friend_request')
 @login_required
 def reject_friend_request():
     """Reject a friend request"""
@@ -288,6 +437,7 @@ def reject_friend_request():
     return jsonify({'message': 'Friend request rejected'}), 200
 
 @app.route('/api/contacts/remove', methods=['POST'])
+@rate_limited('contacts')
 @login_required
 def remove_contact():
     """Remove a contact and delete all chat history"""
@@ -305,24 +455,22 @@ def remove_contact():
     contact_username = contact_user['username'] if contact_user else 'User'
     
     # Remove mutual contact and all messages
-    Contact.remove_mutual(current_user.id, contact_id)
+    my_version, their_version = Contact.remove_mutual(current_user.id, contact_id)
     
     # Notify the other user via WebSocket
-    if contact_id in active_users:
-        contact_sid = active_users[contact_id]
-        socketio.emit('contact_removed', {
-            'removed_by_username': current_user.username,
-            'removed_by_id': current_user.id
-        }, room=contact_sid)
-        
-        # Send updated contact list to the other user
-        updated_contacts = Contact.get_contacts(contact_id)
-        socketio.emit('contacts_updated', {'contacts': updated_contacts}, room=contact_sid)
-    
-    # Send updated contact list to current user
-    if current_user.id in active_users:
-        my_contacts = Contact.get_contacts(current_user.id)
-        socketio.emit('contacts_updated', {'contacts': my_contacts}, room=active_users[current_user.id])
+    socketio.emit('contact_removed', {
+        'contact_id': current_user.id,
+        'version': their_version,
+        'removed_by_username': current_user.username,
+        'removed_by_id': current_user.id
+    }, to=user_channel(contact_id))
+    
+    # Remove the entry from the current user's list too (all of their tabs)
+    socketio.emit('contact_removed', {
+        'contact_id': contact_id,
+        'version': my_version,
+        'removed_by_id': current_user.id
+    }, to=user_channel(current_user.id))
     
     return jsonify({
         'message': 'Contact removed and chat history deleted',
@@ -330,6 +478,7 @@ def remove_contact():
     }), 200
 
 @app.route('/api/messages/image', methods=['POST'])
+@rate_limited('image_upload')
 @login_required
 def upload_image():
     """Handle image upload and send as message"""
@@ -375,27 +524,25 @@ def upload_image():
         )
         
         # Send via WebSocket to recipient if online
-        if recipient_id in active_users:
-            socketio.emit('new_message', {
-                'sender_id': current_user.id,
-                'sender_username': current_user.username,
-                'content': data_uri,
-                'type': 'image',
-                'timestamp': message['timestamp'].isoformat(),
-                'is_mine': False
-            }, room=active_users[recipient_id])
+        socketio.emit('new_message', {
+            'sender_id': current_user.id,
+            'sender_username': current_user.username,
+            'content': data_uri,
+            'type': 'image',
+            'timestamp': message['timestamp'].isoformat(),
+            'is_mine': False
+        }, to=user_channel(recipient_id))
         
         # Send confirmation to sender
-        if current_user.id in active_users:
-            socketio.emit('new_message', {
-                'sender_id': current_user.id,
-                'sender_username': current_user.username,
-                'recipient_id': recipient_id,
-                'content': data_uri,
-                'type': 'image',
-                'timestamp': message['timestamp'].isoformat(),
-                'is_mine': True
-            }, room=active_users[current_user.id])
+        socketio.emit('new_message', {
+            'sender_id': current_user.id,
+            'sender_username': current_user.username,
+            'recipient_id': recipient_id,
+            'content': data_uri,
+            'type': 'image',
+            'timestamp': message['timestamp'].isoformat(),
+            'is_mine': True
+        }, to=user_channel(current_user.id))
         
         return jsonify({
             'success': True,
@@ -407,33 +554,380 @@ def upload_image():
         print(f"❌ Error uploading image: {e}")
         return jsonify({'error': 'Failed to upload image'}), 500
 
+# Chunked, resumable uploads
+@app.route('/api/uploads', methods=['POST'])
+@rate_limited('upload')
+@login_required
+def start_upload():
+    """Start a chunked upload (filename, size, recipient_id, optional sha256)"""
+    if not DB_AVAILABLE:
+        return jsonify({'error': 'Database not configured'}), 500
+    
+    data = request.json
+    filename = data.get('filename')
+    size = data.get('size')
+    recipient_id = data.get('recipient_id')
+    sha256 = data.get('sha256')
+    
+    # bool is an int too, and a non-string ID would reach Mongo as an operator
+    if (not isinstance(filename, str) or not filename or not isinstance(size, int) or isinstance(size, bool)
+            or not isinstance(recipient_id, str) or not ObjectId.is_valid(recipient_id)):
+        return jsonify({'error': 'Filename, size and recipient ID required'}), 400
+    if sha256 is not None and not isinstance(sha256, str):
+        return jsonify({'error': 'Invalid sha256'}), 400
+    
+    if not Contact.is_contact(current_user.id, recipient_id):
+        return jsonify({'error': 'Not in contacts'}), 400
+    
+    try:
+        meta = upload_store.create(current_user.id, recipient_id, filename, size, sha256)
+    except UploadError as e:
+        return jsonify({'error': e.message}), e.status
+    
+    return jsonify(UploadStore.status(meta)), 201
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+@rate_limited('upload')
+@login_required
+def get_upload_status(upload_id):
+    """Where to resume an interrupted upload"""
+    meta = upload_store.load(upload_id, current_user.id)
+    if not meta:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    return jsonify(UploadStore.status(meta)), 200
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@rate_limited('upload_chunk')
+@login_required
+def upload_chunk(upload_id, index):
+    """Receive one chunk as the raw request body (streamed to disk)"""
+    meta = upload_store.load(upload_id, current_user.id)
+    if not meta:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    try:
+        meta = upload_store.write_chunk(meta, index, request.stream)
+    except UploadError as e:
+        return jsonify({'error': e.message, **UploadStore.status(upload_store.load(upload_id, current_user.id) or meta)}), e.status
+    
+    return jsonify(UploadStore.status(meta)), 200
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+@rate_limited('upload')
+@login_required
+def complete_upload(upload_id):
+    """Verify a finished upload and send it as a message (safe to retry)"""
+    if not DB_AVAILABLE:
+        return jsonify({'error': 'Database not configured'}), 500
+    
+    try:
+        file_info = upload_store.complete(upload_id, current_user.id)
+    except UploadError as e:
+        return jsonify({'error': e.message}), e.status
+    
+    recipient_id = file_info['recipient_id']
+    file_url = f"/api/files/{file_info['file_id']}"
+    attachment = {
+        'file_id': file_info['file_id'],
+        'filename': file_info['filename'],
+        'size': file_info['size']
+    }
+    
+    # One message per upload: a retried /complete finds the one already sent
+    try:
+        message = Message.create(
+            sender_id=current_user.id,
+            recipient_id=recipient_id,
+            content=file_url,
+            message_type=file_info['kind'],
+            attachment=attachment,
+            client_msg_id=f"upload-{file_info['file_id']}"
+        )
+    except DuplicateMessage:
+        return jsonify({'success': True, 'url': file_url, 'sha256': file_info['sha256']}), 200
+    
+    msg_data = {
+        'id': str(message['_id']),
+        'sender_id': current_user.id,
+        'sender_username': current_user.username,
+        'recipient_id': recipient_id,
+        'content': file_url,
+        'type': file_info['kind'],
+        'attachment': attachment,
+        'timestamp': message['timestamp'].isoformat(),
+        'is_mine': False
+    }
+    
+    socketio.emit('new_message', msg_data, to=user_channel(recipient_id))
+    socketio.emit('new_message', {**msg_data, 'is_mine': True}, to=user_channel(current_user.id))
+    
+    return jsonify({'success': True, 'url': file_url, 'sha256': file_info['sha256']}), 200
+
+@app.route('/api/files/<file_id>', methods=['GET'])
+@rate_limited('file_download')
+@login_required
+def get_file(file_id):
+    """Download an uploaded file (sender and recipient only)"""
+    file_info = upload_store.get_file(file_id)
+    if not file_info or current_user.id not in (file_info['owner_id'], file_info['recipient_id']):
+        return jsonify({'error': 'Not found'}), 404
+    
+    # File IDs are never reused, so the content can be cached for good
+    response = send_file(upload_store.file_path(file_info),
+                         as_attachment=file_info['kind'] != 'image',
+                         download_name=file_info['filename'],
+                         conditional=True,
+                         max_age=31536000)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+# Longer queries are rejected before they reach the index
+MAX_SEARCH_QUERY_LENGTH = 200
+
+@app.route('/api/messages/search', methods=['GET'])
+@rate_limited('message_search')
+@login_required
+def search_messages():
+    """Full-text search over the user's conversations (cursor paged)"""
+    if not DB_AVAILABLE:
+        return jsonify({'error': 'Database not configured'}), 500
+    
+    query = request.args.get('q', '').strip()
+    contact_id = request.args.get('contact_id')
+    cursor = request.args.get('cursor')
+    
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 50)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    
+    if len(query) < 2:
+        return jsonify({'messages': [], 'next_cursor': None}), 200
+    if len(query) > MAX_SEARCH_QUERY_LENGTH:
+        return jsonify({'error': f'Query too long (max {MAX_SEARCH_QUERY_LENGTH} characters)'}), 400
+    
+    if cursor and not ObjectId.is_valid(cursor):
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    messages, next_cursor = MessageSearch.search(current_user.id, query,
+                                                 contact_id=contact_id,
+                                                 cursor=cursor,
+                                                 limit=limit)
+    
+    # Look up all other participants in one query
+    other_ids = {msg['recipient'] if msg['sender'] == current_user.id else msg['sender'] for msg in messages}
+    usernames = {
+        str(user['_id']): user['username']
+        for user in db['users'].find({'_id': {'$in': [ObjectId(uid) for uid in other_ids]}}, {'username': 1})
+    }
+    usernames[current_user.id] = current_user.username
+    
+    results = []
+    for msg in messages:
+        results.append({
+            'id': str(msg['_id']),
+            'sender_id': msg['sender'],
+            'sender_name': usernames.get(msg['sender'], 'User'),
+            'recipient_id': msg['recipient'],
+            'content': msg['content'],
+            'type': msg.get('type', 'text'),
+            'timestamp': msg['timestamp'].isoformat(),
+            'is_mine': msg['sender'] == current_user.id
+        })
+    
+    return jsonify({'messages': results, 'next_cursor': next_cursor}), 200
+
+# Group Room APIs
+@app.route('/api/rooms', methods=['GET'])
+@rate_limited('rooms')
+@login_required
+def get_rooms():
+    """Get rooms the user belongs to"""
+    if not DB_AVAILABLE:
+        return jsonify({'error': 'Database not configured'}), 500
+    
+    return jsonify({'rooms': Room.get_rooms_for_user(current_user.id)}), 200
+
+@app.route('/api/rooms', methods=['POST'])
+@rate_limited('rooms')
+@login_required
+def create_room():
+    """Create a group room with some of the user's contacts"""
+    if not DB_AVAILABLE:
+        return jsonify({'error': 'Database not configured'}), 500
+    
+    data = request.json
+    name = data.get('name')
+    member_ids = data.get('member_ids') or []
+    
+    name = name.strip() if isinstance(name, str) else ''
+    if not name or len(name) > ROOM_NAME_MAX_LENGTH:
+        return jsonify({'error': f'Room name must be 1-{ROOM_NAME_MAX_LENGTH} characters'}), 400
+    
+    # Validate everything before the room is inserted, so a bad request leaves nothing behind
+    if not isinstance(member_ids, list) or len(member_ids) > ROOM_MAX_INITIAL_MEMBERS:
+        return jsonify({'error': f'member_ids must be a list of up to {ROOM_MAX_INITIAL_MEMBERS} user IDs'}), 400
+    if not all(isinstance(member_id, str) and ObjectId.is_valid(member_id) for member_id in member_ids):
+        return jsonify({'error': 'Invalid user ID'}), 400
+    member_ids = [member_id for member_id in dict.fromkeys(member_ids) if member_id != current_user.id]
+    
+    # Only contacts can be added to a room
+    for member_id in member_ids:
+        if not Contact.is_contact(current_user.id, member_id):
+            return jsonify({'error': 'Can only add contacts to a room'}), 400
+    
+    room = Room.create(name, current_user.id, member_ids)
+    room_id = str(room['_id'])
+    room_info = {
+        'id': room_id,
+        'name': room['name'],
+        'owner_id': room['owner_id'],
+        'member_count': room['member_count']
+    }
+    
+    # Subscribe members connected here right away; connections on other
+    # workers subscribe themselves ('sync_rooms') when room_joined arrives
+    for member_id in [current_user.id, *member_ids]:
+        for sid in local_sids(member_id):
+            join_room(room_channel(room_id), sid=sid, namespace='/')
+        socketio.emit('room_joined', {'room': room_info}, to=user_channel(member_id))
+    
+    return jsonify({'room': room_info}), 201
+
+@app.route('/api/rooms/<room_id>/members', methods=['GET'])
+@rate_limited('rooms')
+@login_required
+def get_room_members(room_id):
+    """Page through room members (cursor = last member ID of the previous page)"""
+    if not DB_AVAILABLE:
+        return jsonify({'error': 'Database not configured'}), 500
+    
+    if not ObjectId.is_valid(room_id) or not Room.is_member(room_id, current_user.id):
+        return jsonify({'error': 'Room not found'}), 404
+    
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    
+    members, next_cursor = Room.get_members(room_id, after=request.args.get('cursor'), limit=limit)
+    return jsonify({'members': members, 'next_cursor': next_cursor}), 200
+
+@app.route('/api/rooms/members/add', methods=['POST'])
+@rate_limited('rooms')
+@login_required
+def add_room_member():
+    """Add one of your contacts to a room you belong to"""
+    if not DB_AVAILABLE:
+        return jsonify({'error': 'Database not configured'}), 500
+    
+    data = request.json
+    room_id = data.get('room_id')
+    user_id = data.get('user_id')
+    
+    if not room_id or not user_id:
+        return jsonify({'error': 'Room ID and user ID required'}), 400
+    
+    if not isinstance(room_id, str) or not ObjectId.is_valid(room_id) or not Room.is_member(room_id, current_user.id):
+        return jsonify({'error': 'Room not found'}), 404
+    
+    if not isinstance(user_id, str) or not ObjectId.is_valid(user_id):
+        return jsonify({'error': 'Invalid user ID'}), 400
+    
+    if not Contact.is_contact(current_user.id, user_id):
+        return jsonify({'error': 'Can only add contacts to a room'}), 400
+    
+    if not Room.add_members(room_id, [user_id]):
+        return jsonify({'error': 'Already a member'}), 400
+    cache_invalidation.publish('room_members', room_id)
+    
+    room = Room.get(room_id)
+    room_info = {
+        'id': room_id,
+        'name': room['name'],
+        'owner_id': room['owner_id'],
+        'member_count': room.get('member_count', 0)
+    }
+    
+    for sid in local_sids(user_id):
+        join_room(room_channel(room_id), sid=sid, namespace='/')
+    socketio.emit('room_joined', {'room': room_info}, to=user_channel(user_id))
+    
+    socketio.emit('room_members_changed', {
+        'room_id': room_id,
+        'added': user_id,
+        'member_count': room_info['member_count']
+    }, to=room_channel(room_id))
+    
+    return jsonify({'room': room_info}), 200
+
+@app.route('/api/rooms/leave', methods=['POST'])
+@rate_limited('rooms')
+@login_required
+def leave_group_room():
+    """Leave a room"""
+    if not DB_AVAILABLE:
+        return jsonify({'error': 'Database not configured'}), 500
+    
+    data = request.json
+    room_id = data.get('room_id')
+    
+    if not room_id or not ObjectId.is_valid(room_id):
+        return jsonify({'error': 'Room ID required'}), 400
+    
+    if not Room.remove_member(room_id, current_user.id):
+        return jsonify({'error': 'Room not found'}), 404
+    cache_invalidation.publish('room_members', room_id)
+    
+    for sid in local_sids(current_user.id):
+        leave_room(room_channel(room_id), sid=sid, namespace='/')
+    socketio.emit('room_left', {'room_id': room_id}, to=user_channel(current_user.id))
+    
+    socketio.emit('room_members_changed', {
+        'room_id': room_id,
+        'removed': current_user.id
+    }, to=room_channel(room_id))
+    
+    return jsonify({'message': 'Left room'}), 200
+
 # WebSocket Events
-def notify_contacts_status_change(user_id, online):
-    """Notify all contacts when a user's status changes"""
-    # Get all users who have this user as a contact
-    contacts_with_user = contacts_collection.find({'contact_id': user_id})
-    
-    for contact_entry in contacts_with_user:
-        contact_user_id = contact_entry['user_id']
-        if contact_user_id in active_users:
-            # Send updated contact list to this user
-            updated_contacts = Contact.get_contacts(contact_user_id)
-            socketio.emit('contacts_updated', {
-                'contacts': updated_contacts
-            }, room=active_users[contact_user_id])
+def notify_contacts_status_change(user_id, username, online, versions):
+    """Notify all contacts when a user's status changes (one changed entry each)"""
+    contact = {'id': user_id, 'username': username, 'online': online}
+    
+    # versions: watcher ID -> new version of their list, from set_online_status
+    for watcher_id, version in versions.items():
+        socketio.emit('contact_updated', {'contact': contact, 'version': version}, to=user_channel(watcher_id))
 
 @socketio.on('connect')
 def handle_connect():
     """Handle WebSocket connection"""
+    # A draining worker takes no new clients (they retry on another worker)
+    if draining.is_set():
+        return False
+    
+    # Reject reconnect storms before loading the user
+    allowed, _ = limiter.allow('connect', request_identity('user'))
+    if not allowed:
+        return False
+    
     if current_user.is_authenticated:
-        # Track active user
-        active_users[current_user.id] = request.sid
+        # Track active user (one user may have several tabs, on several workers)
+        active_users.setdefault(current_user.id, set()).add(request.sid)
+        if DB_AVAILABLE:
+            SocketSession.add(request.sid, current_user.id, app.config['WORKER_ID'])
+        join_room(user_channel(current_user.id))
+        
+        # Subscribe to all of the user's group rooms
+        for room_id in Room.get_room_ids_for_user(current_user.id):
+            join_room(room_channel(room_id))
         
         # Set user as online in database
-        Contact.set_online_status(current_user.id, online=True)
+        versions = Contact.set_online_status(current_user.id, online=True)
         
         # Notify all contacts that this user is now online
-        notify_contacts_status_change(current_user.id, online=True)
+        notify_contacts_status_change(current_user.id, current_user.username, True, versions)
         
         print(f'✅ User {current_user.username} connected')
 
@@ -442,30 +936,118 @@ def handle_disconnect():
     """Handle WebSocket disconnection"""
     if current_user.is_authenticated:
         # Remove from active users
-        if current_user.id in active_users:
-            del active_users[current_user.id]
+        sids = active_users.get(current_user.id)
+        if sids is not None:
+            sids.discard(request.sid)
+            if not sids:
+                del active_users[current_user.id]
+        
+        # Still connected in another tab (or through another worker)
+        if DB_AVAILABLE and not SocketSession.remove(request.sid, current_user.id):
+            return
         
         # Set user as offline in database
-        Contact.set_online_status(current_user.id, online=False)
+        versions = Contact.set_online_status(current_user.id, online=False)
         
         # Notify all contacts that this user is now offline
-        notify_contacts_status_change(current_user.id, online=False)
+        notify_contacts_status_change(current_user.id, current_user.username, False, versions)
         
         print(f'❌ User {current_user.username} disconnected')
 
+@socketio.on('contacts_sync')
+@rate_limited_event('contacts')
+def handle_contacts_sync(data):
+    """Send contact changes since the client's version (e.g. after a reconnect)"""
+    if not current_user.is_authenticated or not DB_AVAILABLE:
+        return
+    
+    try:
+        since_version = int((data or {}).get('since_version', 0))
+    except (TypeError, ValueError):
+        return
+    
+    if since_version <= 0:
+        emit('contacts_synced', Contact.get_snapshot(current_user.id))
+    else:
+        emit('contacts_synced', Contact.get_changes(current_user.id, since_version))
+
+@socketio.on('sync_rooms')
+@rate_limited_event('rooms')
+def handle_sync_rooms(data=None):
+    """Match this connection's room channels to the user's memberships (after room_joined/room_left)"""
+    if not current_user.is_authenticated or not DB_AVAILABLE:
+        return
+    
+    wanted = {room_channel(room_id) for room_id in Room.get_room_ids_for_user(current_user.id)}
+    current = {name for name in rooms() if name.startswith('room:')}
+    
+    for name in wanted - current:
+        join_room(name)
+    for name in current - wanted:
+        leave_room(name)
+
+@socketio.on('typing')
+@rate_limited_event('typing')
+def handle_typing(data):
+    """Forward a typing indicator to a contact (throttled, never stored)"""
+    user_id = session.get('_user_id')
+    contact_id = data.get('conversation') if isinstance(data, dict) else None
+    
+    if not user_id or not contact_id or not DB_AVAILABLE:
+        return
+    
+    if data.get('typing', True):
+        # Throttle before any lookups so keystrokes cost nothing in between
+        if not typing_throttle.start(user_id, contact_id):
+            return
+        if not Contact.is_contact(user_id, contact_id):
+            typing_throttle.deny(user_id, contact_id)
+            return
+        typing = True
+    else:
+        # Only send 'stopped' if a 'started' actually went out
+        if not typing_throttle.stop(user_id, contact_id):
+            return
+        typing = False
+    
+    socketio.emit('typing', {'user_id': user_id, 'typing': typing}, to=user_channel(contact_id))
+
+@socketio.on('read_up_to')
+@rate_limited_event('read_up_to')
+def handle_read_up_to(data):
+    """Buffer a read watermark, written and forwarded on the next flush"""
+    user_id = session.get('_user_id')
+    if not user_id or not isinstance(data, dict) or not DB_AVAILABLE:
+        return
+    
+    contact_id = data.get('conversation')
+    message_id = data.get('message_id')
+    
+    # Conversations are user IDs; anything else could only cost a wasted update
+    if isinstance(contact_id, str) and ObjectId.is_valid(contact_id) and message_id:
+        read_receipts.add(user_id, contact_id, message_id)
+
 @socketio.on('load_conversation')
+@rate_limited_event('load_conversation')
 def handle_load_conversation(data):
     """Load conversation history with a contact"""
     if not current_user.is_authenticated or not DB_AVAILABLE:
         return
     
     contact_id = data.get('contact_id')
+    before = data.get('before')  # ID of the oldest loaded message (for paging back)
     
     if not contact_id:
         return
     
-    # Load messages
-    messages = Message.get_conversation(current_user.id, contact_id)
+    if before:
+        if not isinstance(before, str) or not ObjectId.is_valid(before):
+            return
+        before = ObjectId(before)
+    
+    # Load messages (reads archived history transparently)
+    limit = 50
+    messages = Message.get_conversation(current_user.id, contact_id, limit=limit, before=before)
     
     # Format messages
     formatted_messages = []
@@ -476,14 +1058,21 @@ def handle_load_conversation(data):
             'sender_id': msg['sender'],
             'sender_name': current_user.username if msg['sender'] == current_user.id else contact['username'],
             'content': msg['content'],
-            'type': msg.get('type', 'text'),  # Include message type (text or image)
+            'type': msg.get('type', 'text'),  # Include message type (text, image or file)
+            'attachment': msg.get('attachment'),
             'timestamp': msg['timestamp'].isoformat(),
-            'is_mine': msg['sender'] == current_user.id
+            'is_mine': msg['sender'] == current_user.id,
+            'read': msg.get('read', False)
         })
     
-    emit('conversation_loaded', {'messages': formatted_messages})
+    emit('conversation_loaded', {
+        'messages': formatted_messages,
+        'before': data.get('before'),
+        'has_more': len(messages) == limit
+    })
 
 @socketio.on('send_private_message')
+@rate_limited_event('send_private_message')
 def handle_private_message(data):
     """Send private message to a contact"""
     if not current_user.is_authenticated or not DB_AVAILABLE:
@@ -491,41 +1080,214 @@ def handle_private_message(data):
     
     recipient_id = data.get('recipient_id')
     content = data.get('content')
+    client_msg_id = data.get('client_msg_id')  # Same ID on every retry of this send
     
     if not recipient_id or not content:
         return
     
+    if replay_send(client_msg_id, 'message_sent'):
+        return
+    
     # Check if they are contacts
     if not Contact.is_contact(current_user.id, recipient_id):
+        recent_sends.release(current_user.id, client_msg_id)
         emit('error', {'message': 'Not in contacts'})
         return
     
     # Save message
-    message = Message.create(current_user.id, recipient_id, content)
+    try:
+        message = Message.create(current_user.id, recipient_id, content, client_msg_id=client_msg_id)
+    except DuplicateMessage as e:
+        # Stored by an attempt that went through another worker (or before a restart)
+        msg_data = sent_message_data(e.message)
+        recent_sends.done(current_user.id, client_msg_id, msg_data)
+        emit('message_sent', msg_data)
+        return
+    except Exception:
+        recent_sends.release(current_user.id, client_msg_id)
+        raise
     
     # Format message
-    msg_data = {
-        'id': str(message['_id']),
-        'sender_id': current_user.id,
-        'sender_name': current_user.username,
-        'recipient_id': recipient_id,
-        'content': content,
-        'type': 'text',  # Text message type
-        'timestamp': message['timestamp'].isoformat(),
-        'is_mine': True
-    }
+    msg_data = sent_message_data(message)
+    if client_msg_id:
+        recent_sends.done(current_user.id, client_msg_id, msg_data)
     
     # Send to sender
     emit('message_sent', msg_data)
     
     # Send to recipient if online
-    if recipient_id in active_users:
-        recipient_sid = active_users[recipient_id]
-        msg_data['is_mine'] = False
-        socketio.emit('new_message', msg_data, room=recipient_sid)
+    socketio.emit('new_message', {**msg_data, 'is_mine': False}, to=user_channel(recipient_id))
     
     print(f'💬 {current_user.username} → Contact: {content}')
 
+@socketio.on('load_room_history')
+@rate_limited_event('load_room_history')
+def handle_load_room_history(data):
+    """Load a page of group room history"""
+    if not current_user.is_authenticated or not DB_AVAILABLE:
+        return
+    
+    room_id = data.get('room_id')
+    before = data.get('before')  # ID of the oldest loaded message (for paging back)
+    
+    if not room_id or not ObjectId.is_valid(room_id) or not Room.is_member(room_id, current_user.id):
+        return
+    
+    if before:
+        if not isinstance(before, str) or not ObjectId.is_valid(before):
+            return
+        before = ObjectId(before)
+    
+    messages = Message.get_room_history(room_id, limit=ROOM_HISTORY_LIMIT, before=before)
+    
+    # Resolve sender names in one query
+    sender_ids = {msg['sender'] for msg in messages}
+    usernames = {
+        str(user['_id']): user['username']
+        for user in db['users'].find({'_id': {'$in': [ObjectId(uid) for uid in sender_ids]}}, {'username': 1})
+    }
+    
+    formatted_messages = []
+    for msg in messages:
+        formatted_messages.append({
+            'id': str(msg['_id']),
+            'room_id': room_id,
+            'sender_id': msg['sender'],
+            'sender_name': usernames.get(msg['sender'], 'User'),
+            'content': msg['content'],
+            'type': msg.get('type', 'text'),
+            'timestamp': msg['timestamp'].isoformat(),
+            'is_mine': msg['sender'] == current_user.id
+        })
+    
+    emit('room_history_loaded', {
+        'room_id': room_id,
+        'messages': formatted_messages,
+        'before': data.get('before'),
+        'has_more': len(messages) == ROOM_HISTORY_LIMIT
+    })
+
+@socketio.on('send_room_message')
+@rate_limited_event('send_room_message')
+def handle_room_message(data):
+    """Send a message to a group room (one insert, one emit)"""
+    if not current_user.is_authenticated or not DB_AVAILABLE:
+        return
+    
+    room_id = data.get('room_id')
+    content = data.get('content')
+    client_msg_id = data.get('client_msg_id')
+    
+    if not room_id or not content or not ObjectId.is_valid(room_id):
+        return
+    
+    if replay_send(client_msg_id, 'room_message_sent'):
+        return
+    
+    if not Room.is_member(room_id, current_user.id):
+        recent_sends.release(current_user.id, client_msg_id)
+        emit('error', {'message': 'Not a member of this room'})
+        return
+    
+    try:
+        message = Message.create_room_message(current_user.id, room_id, content, client_msg_id=client_msg_id)
+    except DuplicateMessage as e:
+        msg_data = sent_message_data(e.message)
+        recent_sends.done(current_user.id, client_msg_id, msg_data)
+        emit('room_message_sent', msg_data)
+        return
+    except Exception:
+        recent_sends.release(current_user.id, client_msg_id)
+        raise
+    
+    msg_data = sent_message_data(message)
+    if client_msg_id:
+        recent_sends.done(current_user.id, client_msg_id, msg_data)
+    
+    emit('room_message_sent', msg_data)
+    
+    # Single emit to the Socket.IO room reaches every connected member
+    emit('new_room_message', {**msg_data, 'is_mine': False}, to=room_channel(room_id), include_self=False)
+
+# Background jobs
+def run_upload_cleanup():
+    """Periodically remove abandoned upload sessions"""
+    while True:
+        socketio.sleep(app.config['UPLOAD_CLEANUP_SECONDS'])
+        try:
+            removed = upload_store.cleanup()
+            if removed:
+                print(f"🧹 Removed {removed} abandoned uploads")
+        except Exception as e:
+            print(f"❌ Error cleaning up uploads: {e}")
+
+def run_read_receipt_flusher():
+    """Flush coalesced read receipts in batches"""
+    while True:
+        socketio.sleep(READ_RECEIPT_FLUSH_SECONDS)
+        read_receipts.flush()
+
+def run_archiver():
+    """Periodically move old messages out of the hot collection"""
+    try:
+        # Archive months created before history paged by _id
+        MessageArchive.ensure_indexes()
+    except Exception as e:
+        print(f"❌ Error indexing message archives: {e}")
+    
+    while True:
+        socketio.sleep(app.config['ARCHIVE_INTERVAL_SECONDS'])
+        try:
+            MessageArchive.archive_old_messages()
+            Contact.purge_tombstones()
+        except Exception as e:
+            print(f"❌ Error archiving messages: {e}")
+
+def start_worker(primary=True):
+    """
+    Per-process startup. Only the primary process runs the periodic jobs
+    that touch shared data (archiving, upload cleanup), so N workers don't
+    repeat them N times.
+    """
+    if DB_AVAILABLE:
+        # Connections left behind by a previous process with our ID are gone
+        for user_id in SocketSession.clear_worker(app.config['WORKER_ID']):
+            versions = Contact.set_online_status(user_id, online=False)
+            user = User.get_by_id(user_id)
+            if user:
+                notify_contacts_status_change(user_id, user['username'], False, versions)
+        
+        socketio.start_background_task(run_read_receipt_flusher)
+        if cache_invalidation.shared:
+            socketio.start_background_task(cache_invalidation.listen)
+        if primary:
+            socketio.start_background_task(run_archiver)
+    if primary:
+        socketio.start_background_task(run_upload_cleanup)
+
+def drain_connections(seconds):
+    """
+    Hand this process' clients over to other workers before it stops:
+    new connections are refused, connected clients are told to reconnect at a
+    random point within `seconds` (so they don't all land at once), and
+    whoever is left after that is disconnected.
+    """
+    draining.set()
+    sids = [sid for user_sids in list(active_users.values()) for sid in user_sids]
+    print(f"🚰 Draining {len(sids)} connections over {seconds}s")
+    
+    for sid in sids:
+        socketio.emit('server_draining', {'reconnect_within': seconds}, to=sid)
+    socketio.sleep(seconds)
+    
+    for user_sids in list(active_users.values()):
+        for sid in list(user_sids):
+            socketio.server.disconnect(sid, namespace='/')
+    
+    # Don't lose read receipts still waiting for the next flush
+    if DB_AVAILABLE:
+        read_receipts.flush()
+
 if __name__ == '__main__':
     if not DB_AVAILABLE:
         print("\n" + "="*60)
@@ -537,7 +1299,9 @@ if __name__ == '__main__':
         print("3. Run: pip3 install -r requirements.txt")
         print("\n" + "="*60 + "\n")
     
-    # Run the app
+    start_worker()
+    
+    # Run the app (single process for development, see server.py for production)
     use_ssl = os.getenv('USE_SSL', 'true').lower() == 'true'
     
     if use_ssl:
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Connection capacity benchmark
+Starts server.py with 1, 2, 4, ... workers and opens Socket.IO connections
+(WebSocket transport, Engine.IO handshake plus namespace connect) from several
+client processes, reporting connect throughput and latency for each run.
+
+Needs MongoDB (the app connects on import) and, for more than one worker,
+SOCKETIO_MESSAGE_QUEUE (e.g. redis://localhost:6379/0).
+
+Usage: python benchmarks/connection_benchmark.py [--workers 1,2,4] [--connections 20000]
+"""
+
+import argparse
+import base64
+import json
+import os
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+# Client side: a minimal Engine.IO v4 / Socket.IO v5 WebSocket client
+
+def ws_send(sock, text):
+    """Send one masked text frame"""
+    payload = text.encode()
+    mask = os.urandom(4)
+    header = bytes([0x81])
+    if len(payload) < 126:
+        header += bytes([0x80 | len(payload)])
+    else:
+        header += bytes([0x80 | 126]) + struct.pack('!H', len(payload))
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    sock.sendall(header + mask + masked)
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('closed')
+        data += chunk
+    return data
+
+
+def ws_recv(sock):
+    """Receive one (unmasked, unfragmented) text frame from the server"""
+    first, second = recv_exact(sock, 2)
+    length = second & 0x7f
+    if length == 126:
+        length = struct.unpack('!H', recv_exact(sock, 2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', recv_exact(sock, 8))[0]
+    return recv_exact(sock, length).decode()
+
+
+def open_connection(host, port):
+    """Handshake until the Socket.IO namespace is connected, returns the socket"""
+    sock = socket.create_connection((host, port))
+    key = base64.b64encode(os.urandom(16)).decode()
+    sock.sendall((
+        'GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\n'
+        f'Host: {host}:{port}\r\n'
+        'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+        f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n'
+    ).encode())
+
+    response = b''
+    while b'\r\n\r\n' not in response:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError('closed during upgrade')
+        response += chunk
+    if b' 101 ' not in response.split(b'\r\n', 1)[0]:
+        raise ConnectionError(response.split(b'\r\n', 1)[0].decode())
+
+    if not ws_recv(sock).startswith('0'):      # Engine.IO open
+        raise ConnectionError('no open packet')
+    ws_send(sock, '40')                        # Socket.IO connect
+    while True:
+        packet = ws_recv(sock)
+        if packet.startswith('40'):
+            return sock
+        if packet.startswith('44'):
+            raise ConnectionError('connect refused')
+        if packet == '2':
+            ws_send(sock, '3')
+
+
+def run_client(host, port, count, concurrency, hold):
+    """Open `count` connections, `concurrency` at a time; print latencies as JSON"""
+    import eventlet
+    eventlet.monkey_patch()
+
+    latencies = []
+    errors = 0
+    held = []
+
+    def one():
+        nonlocal errors
+        began = time.perf_counter()
+        try:
+            held.append(open_connection(host, port))
+            latencies.append((time.perf_counter() - began) * 1000)
+        except (OSError, ConnectionError, ValueError):
+            errors += 1
+
+    began = time.perf_counter()
+    pool = eventlet.GreenPool(concurrency)
+    for _ in range(count):
+        pool.spawn_n(one)
+    pool.waitall()
+    elapsed = time.perf_counter() - began
+
+    # Keep them open for a moment: capacity means connections that stay up
+    eventlet.sleep(hold)
+    alive = 0
+    for sock in held:
+        try:
+            sock.setblocking(False)
+            alive += sock.recv(1, socket.MSG_PEEK) != b''
+        except BlockingIOError:
+            alive += 1
+        except OSError:
+            pass
+        sock.close()
+
+    print(json.dumps({'latencies': latencies, 'errors': errors, 'elapsed': elapsed, 'alive': alive}))
+
+
+# Orchestration
+
+def start_server(workers, port):
+    env = dict(os.environ,
+               WEB_WORKERS=str(workers),
+               PORT=str(port),
+               USE_SSL='false',
+               DRAIN_SECONDS='1',
+               RATE_LIMITS='connect=100000000/1')
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'server.py')], env=env, cwd=ROOT,
+                               stdout=subprocess.DEVNULL)
+
+    # Ready once every worker listens (the balancer only routes to ready workers)
+    base_port = int(os.getenv('WORKER_BASE_PORT', '9100'))
+    deadline = time.monotonic() + 60
+    for worker_port in [port] + [base_port + i for i in range(workers)]:
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', worker_port)).close()
+                break
+            except OSError:
+                time.sleep(0.5)
+    time.sleep(2)  # Supervisor polls readiness every 0.5s
+    return process
+
+
+def run_round(workers, args):
+    process = start_server(workers, args.port)
+    try:
+        per_client = args.connections // args.clients
+        clients = [
+            subprocess.Popen([sys.executable, __file__, '--client', '--port', str(args.port),
+                              '--connections', str(per_client),
+                              '--concurrency', str(max(args.concurrency // args.clients, 1)),
+                              '--hold', str(args.hold)],
+                             stdout=subprocess.PIPE)
+            for _ in range(args.clients)
+        ]
+        results = [json.loads(client.communicate()[0]) for client in clients]
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies = sorted(latency for result in results for latency in result['latencies'])
+    elapsed = max(result['elapsed'] for result in results)
+    return {
+        'workers': workers,
+        'opened': len(latencies),
+        'alive': sum(result['alive'] for result in results),
+        'errors': sum(result['errors'] for result in results),
+        'rate': len(latencies) / elapsed if elapsed else 0,
+        'p50': statistics.median(latencies) if latencies else 0,
+        'p99': latencies[int(len(latencies) * 0.99) - 1] if latencies else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark connection capacity across worker counts')
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--connections', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=500)
+    parser.add_argument('--clients', type=int, default=4, help='client processes generating load')
+    parser.add_argument('--hold', type=float, default=5, help='seconds to keep connections open')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--client', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client:
+        run_client('127.0.0.1', args.port, args.connections, args.concurrency, args.hold)
+        return
+
+    print(f"🧪 {args.connections:,} connections per run, {args.clients} client processes")
+    baseline = None
+    for workers in [int(count) for count in args.workers.split(',')]:
+        result = run_round(workers, args)
+        baseline = baseline or result['rate']
+        print(f"{workers:>2} workers  {result['rate']:8,.0f} conn/s  (x{result['rate'] / baseline:4.2f})  "
+              f"p50={result['p50']:7.1f}ms  p99={result['p99']:7.1f}ms  "
+              f"alive={result['alive']:,}/{args.connections:,}  errors={result['errors']:,}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Message search benchmark
+Builds a synthetic corpus (1M messages by default) in a separate database and
+measures MessageSearch.search latency for a few typical query shapes.
+
+Usage: python benchmarks/search_benchmark.py [--messages 1000000] [--keep]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Never benchmark against the real database
+os.environ['DATABASE_NAME'] = os.getenv('BENCH_DATABASE_NAME', 'chatroom_bench')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bson import ObjectId
+from database import client, messages_collection, search_index_collection, MessageSearch, DATABASE_NAME
+
+
+def build_vocabulary(size):
+    """Pseudo-words so term frequencies follow a Zipf-like curve"""
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    rng = random.Random(7)
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    words = sorted(words)
+    weights = [1.0 / (rank + 1) for rank in range(size)]
+    return words, weights
+
+
+def generate_corpus(total, users, vocab_size, batch_size=5000):
+    """Insert `total` text messages plus their search postings"""
+    words, weights = build_vocabulary(vocab_size)
+    user_ids = [str(ObjectId()) for _ in range(users)]
+    rng = random.Random(42)
+    start = datetime.utcnow() - timedelta(days=365)
+
+    inserted = 0
+    began = time.perf_counter()
+    while inserted < total:
+        count = min(batch_size, total - inserted)
+        messages = []
+        for i in range(count):
+            sender, recipient = rng.sample(user_ids, 2)
+            content = ' '.join(rng.choices(words, weights=weights, k=rng.randint(3, 20)))
+            messages.append({
+                '_id': ObjectId(),
+                'sender': sender,
+                'recipient': recipient,
+                'content': content,
+                'type': 'text',
+                'timestamp': start + timedelta(seconds=inserted + i),
+                'read': False
+            })
+
+        messages_collection.insert_many(messages, ordered=False)
+        postings = []
+        for message in messages:
+            postings.extend(MessageSearch.build_postings(message))
+        search_index_collection.insert_many(postings, ordered=False)
+
+        inserted += count
+        rate = inserted / (time.perf_counter() - began)
+        print(f"\r📝 {inserted:,}/{total:,} messages ({rate:,.0f}/s)", end='', flush=True)
+
+    print()
+    return user_ids, words
+
+
+def time_queries(label, runs, fn):
+    """Run fn `runs` times and print latency percentiles in ms"""
+    samples = []
+    for _ in range(runs):
+        began = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - began) * 1000)
+    samples.sort()
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    p99 = samples[int(len(samples) * 0.99) - 1]
+    print(f"{label:<32} p50={statistics.median(samples):7.2f}ms  p95={p95:7.2f}ms  p99={p99:7.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark message search')
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--keep', action='store_true', help='keep the benchmark database afterwards')
+    args = parser.parse_args()
+
+    print(f"🧪 Benchmark database: {DATABASE_NAME}")
+    messages_collection.delete_many({})
+    search_index_collection.delete_many({})
+
+    user_ids, words = generate_corpus(args.messages, args.users, args.vocabulary)
+    print(f"📦 Postings: {search_index_collection.estimated_document_count():,}")
+
+    rng = random.Random(1)
+    common = words[:50]
+    rare = words[-5000:]
+
+    def conversation_partner(user_id):
+        message = messages_collection.find_one({'sender': user_id}, {'recipient': 1})
+        return message['recipient'] if message else None
+
+    def first_page(query, contact=False):
+        user_id = rng.choice(user_ids)
+        contact_id = conversation_partner(user_id) if contact else None
+        return MessageSearch.search(user_id, query, contact_id=contact_id)
+
+    def three_pages():
+        user_id = rng.choice(user_ids)
+        query = rng.choice(common)
+        cursor = None
+        for _ in range(3):
+            _, cursor = MessageSearch.search(user_id, query, cursor=cursor)
+            if not cursor:
+                break
+
+    time_queries('common term', args.runs, lambda: first_page(rng.choice(common)))
+    time_queries('rare term', args.runs, lambda: first_page(rng.choice(rare)))
+    time_queries('two common terms', args.runs, lambda: first_page(' '.join(rng.sample(common, 2))))
+    time_queries('common + rare term', args.runs, lambda: first_page(f"{rng.choice(common)} {rng.choice(rare)}"))
+    time_queries('common term, one contact', args.runs, lambda: first_page(rng.choice(common), contact=True))
+    time_queries('common term, 3 pages', args.runs, three_pages)
+
+    if not args.keep:
+        client.drop_database(DATABASE_NAME)
+        print(f"🗑️ Dropped {DATABASE_NAME}")
+
+
+if __name__ == '__main__':
+    main()
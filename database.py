@@ -2,10 +2,13 @@
 Database configuration and models for MongoDB
 """
 
-from pymongo import MongoClient
-from datetime import datetime
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError
+from datetime import datetime, timedelta
 import bcrypt
 import os
+import re
+import time
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -15,6 +18,15 @@ load_dotenv()
 MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
 DATABASE_NAME = os.getenv('DATABASE_NAME', 'chatroom_db')
 
+# Message archiving (hot/cold tiering)
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_COLLECTION_PREFIX = 'messages_archive_'
+# Another worker may create archive months: re-list at most this often on a miss
+ARCHIVE_NAMES_REFRESH_SECONDS = int(os.getenv('ARCHIVE_NAMES_REFRESH_SECONDS', '30'))
+
+# Group rooms
+ROOM_MEMBER_CACHE_SECONDS = int(os.getenv('ROOM_MEMBER_CACHE_SECONDS', '60'))
+
 client = MongoClient(MONGODB_URI)
 db = client[DATABASE_NAME]
 
@@ -22,11 +34,37 @@ db = client[DATABASE_NAME]
 users_collection = db['users']
 messages_collection = db['messages']
 contacts_collection = db['contacts']
+search_index_collection = db['message_search_index']
+archive_directory_collection = db['messages_archive_directory']
+rooms_collection = db['rooms']
+counters_collection = db['counters']
+room_members_collection = db['room_members']
+socket_sessions_collection = db['socket_sessions']
 
 # Create indexes for better performance
 users_collection.create_index('username', unique=True)
-messages_collection.create_index([('sender', 1), ('recipient', 1), ('timestamp', -1)])
+# History pages by _id: unique, so a page can't end between two messages of the same millisecond
+messages_collection.create_index([('sender', 1), ('recipient', 1), ('_id', -1)])
+# Room messages are stored once per room (not per recipient)
+messages_collection.create_index([('room', 1), ('_id', -1)],
+                                 partialFilterExpression={'room': {'$exists': True}})
+# Retried sends carry the same client-generated ID, stored at most once per sender
+messages_collection.create_index([('sender', 1), ('client_msg_id', 1)], unique=True,
+                                 partialFilterExpression={'client_msg_id': {'$type': 'string'}})
 contacts_collection.create_index([('user_id', 1), ('contact_id', 1)], unique=True)
+# Each version is used once per list: a writer that picks a taken one retries
+contacts_collection.create_index([('user_id', 1), ('version', -1)], unique=True, name='user_version_unique',
+                                 partialFilterExpression={'version': {'$type': 'number'}})
+contacts_collection.create_index('contact_id')
+# Search postings: owner + term, newest message first (contact is kept in the
+# index so conversation-scoped searches are answered from the index alone)
+search_index_collection.create_index([('o', 1), ('t', 1), ('m', -1), ('c', 1)])
+search_index_collection.create_index([('o', 1), ('c', 1)])
+archive_directory_collection.create_index('conversation', unique=True)
+room_members_collection.create_index([('room_id', 1), ('user_id', 1)], unique=True)
+room_members_collection.create_index('user_id')
+socket_sessions_collection.create_index('user_id')
+socket_sessions_collection.create_index('worker')
 
 
 class User:
@@ -91,38 +129,147 @@ class User:
         )
 
 
+class DuplicateMessage(Exception):
+    """A retried send: a message with this client_msg_id is already stored"""
+    
+    def __init__(self, message):
+        super().__init__(f"Message {message['_id']} already stored")
+        self.message = message
+
+
 class Message:
     """Message model for storing chat messages"""
     
     @staticmethod
-    def create(sender_id, recipient_id, content, message_type='text'):
-        """Create a new message (text or image)"""
+    def create(sender_id, recipient_id, content, message_type='text', attachment=None, client_msg_id=None):
+        """
+        Create a new message (text, image or file).
+        Raises DuplicateMessage if client_msg_id was already used by this sender.
+        """
         message_data = {
             'sender': sender_id,
             'recipient': recipient_id,
             'content': content,
-            'type': message_type,  # 'text' or 'image'
+            'type': message_type,  # 'text', 'image' or 'file'
             'timestamp': datetime.utcnow(),
             'read': False
         }
+        if attachment:
+            message_data['attachment'] = attachment  # {file_id, filename, size} for uploaded files
+        if client_msg_id:
+            message_data['client_msg_id'] = client_msg_id
+        
+        Message._insert_once(message_data)
+        
+        # Only text is searchable - image data URIs never reach the index
+        if message_type == 'text':
+            MessageSearch.index_message(message_data)
         
-        result = messages_collection.insert_one(message_data)
-        message_data['_id'] = result.inserted_id
         return message_data
     
     @staticmethod
-    def get_conversation(user1_id, user2_id, limit=50):
-        """Get messages between two users"""
-        messages = messages_collection.find({
+    def get_conversation(user1_id, user2_id, limit=50, before=None):
+        """
+        Get messages between two users (hot collection, then archives).
+        Pass the _id (ObjectId) of the oldest loaded message as `before` to page back.
+        """
+        query = {
             '$or': [
                 {'sender': user1_id, 'recipient': user2_id},
                 {'sender': user2_id, 'recipient': user1_id}
             ]
-        }).sort('timestamp', -1).limit(limit)
+        }
+        if before is not None:
+            query['_id'] = {'$lt': before}
+        
+        messages = list(messages_collection.find(query).sort('_id', -1).limit(limit))
         
+        # Only touch the cold tier when the hot window runs out
+        if len(messages) < limit:
+            key = MessageArchive.conversation_key(user1_id, user2_id)
+            newest = before.generation_time if before is not None else None
+            for collection in MessageArchive.collections(key, before=newest):
+                remaining = limit - len(messages)
+                messages.extend(collection.find(query).sort('_id', -1).limit(remaining))
+                if len(messages) >= limit:
+                    break
         
         # Reverse to show oldest first
-        return list(reversed(list(messages)))
+        return list(reversed(messages))
+    
+    @staticmethod
+    def create_room_message(sender_id, room_id, content, message_type='text', client_msg_id=None):
+        """Create a room message (one document for the whole room), may raise DuplicateMessage"""
+        message_data = {
+            'sender': sender_id,
+            'room': room_id,
+            'content': content,
+            'type': message_type,
+            'timestamp': datetime.utcnow()
+        }
+        if client_msg_id:
+            message_data['client_msg_id'] = client_msg_id
+        
+        return Message._insert_once(message_data)
+    
+    @staticmethod
+    def _insert_once(message_data):
+        """Insert a message, or raise DuplicateMessage with the one stored by an earlier attempt"""
+        try:
+            result = messages_collection.insert_one(message_data)
+        except DuplicateKeyError:
+            existing = messages_collection.find_one({
+                'sender': message_data['sender'],
+                'client_msg_id': message_data.get('client_msg_id')
+            })
+            if existing is None:
+                raise
+            raise DuplicateMessage(existing)
+        
+        message_data['_id'] = result.inserted_id
+        return message_data
+    
+    @staticmethod
+    def get_room_history(room_id, limit=50, before=None):
+        """Get room messages, oldest first (pages back with `before`, an _id; reads archives)"""
+        query = {'room': room_id}
+        if before is not None:
+            query['_id'] = {'$lt': before}
+        
+        messages = list(messages_collection.find(query).sort('_id', -1).limit(limit))
+        
+        if len(messages) < limit:
+            newest = before.generation_time if before is not None else None
+            for collection in MessageArchive.collections(MessageArchive.room_key(room_id), before=newest):
+                remaining = limit - len(messages)
+                messages.extend(collection.find(query).sort('_id', -1).limit(remaining))
+                if len(messages) >= limit:
+                    break
+        
+        return list(reversed(messages))
+    
+    @staticmethod
+    def find_by_ids(message_ids):
+        """Fetch messages by _id from whichever tier holds them (newest first)"""
+        messages = list(messages_collection.find({'_id': {'$in': message_ids}}))
+        
+        found = {msg['_id'] for msg in messages}
+        missing = [mid for mid in message_ids if mid not in found]
+        
+        # Archived messages live in the collection for their _id's month
+        by_collection = {}
+        for mid in missing:
+            by_collection.setdefault(MessageArchive.collection_name(mid.generation_time), []).append(mid)
+        
+        archived = set(MessageArchive.collection_names())
+        if not archived.issuperset(by_collection):
+            archived = set(MessageArchive.collection_names(max_age=ARCHIVE_NAMES_REFRESH_SECONDS))
+        for name, ids in by_collection.items():
+            if name in archived:
+                messages.extend(db[name].find({'_id': {'$in': ids}}))
+        
+        messages.sort(key=lambda msg: msg['_id'], reverse=True)
+        return messages
     
     @staticmethod
     def mark_as_read(message_id):
@@ -132,6 +279,471 @@ class Message:
             {'_id': ObjectId(message_id)},
             {'$set': {'read': True}}
         )
+    
+    @staticmethod
+    def mark_read_up_to(reader_id, sender_id, message_id):
+        """
+        Mark every unread message from sender to reader up to message_id as read
+        in one range update (archived messages are left alone). Returns count updated.
+        """
+        from bson import ObjectId
+        result = messages_collection.update_many(
+            {
+                'sender': sender_id,
+                'recipient': reader_id,
+                '_id': {'$lte': ObjectId(message_id)},
+                'read': False
+            },
+            {'$set': {'read': True}}
+        )
+        return result.modified_count
+
+
+class MessageSearch:
+    """Inverted index over text messages, scoped by participant"""
+    
+    TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+    MIN_TERM_LENGTH = 2
+    MAX_TERM_LENGTH = 40
+    MAX_TERMS_PER_MESSAGE = 64
+    SCAN_BATCH = 200
+    RARITY_COUNT_LIMIT = 10000
+    # Per-request budget: extra query terms are ignored, and a scan that finds
+    # too few matches within MAX_SCAN_BATCHES returns a cursor to continue from
+    MAX_QUERY_TERMS = 8
+    MAX_SCAN_BATCHES = 10
+    
+    @staticmethod
+    def tokenize(text):
+        """Split text into unique lowercase search terms (order preserved)"""
+        terms = []
+        seen = set()
+        for token in MessageSearch.TOKEN_PATTERN.findall(text.lower()):
+            if len(token) < MessageSearch.MIN_TERM_LENGTH or len(token) > MessageSearch.MAX_TERM_LENGTH:
+                continue
+            if token not in seen:
+                seen.add(token)
+                terms.append(token)
+        return terms
+    
+    @staticmethod
+    def build_postings(message):
+        """Build one posting per term for each participant of a text message"""
+        # Room messages are not indexed (one posting per member would not scale)
+        if message.get('type', 'text') != 'text' or 'recipient' not in message:
+            return []
+        
+        terms = MessageSearch.tokenize(message['content'])[:MessageSearch.MAX_TERMS_PER_MESSAGE]
+        sender = message['sender']
+        recipient = message['recipient']
+        
+        postings = []
+        for owner, contact in ((sender, recipient), (recipient, sender)):
+            for term in terms:
+                postings.append({'o': owner, 'c': contact, 't': term, 'm': message['_id']})
+        return postings
+    
+    @staticmethod
+    def index_message(message):
+        """Add a newly created message to the index (incremental update)"""
+        postings = MessageSearch.build_postings(message)
+        if postings:
+            search_index_collection.insert_many(postings, ordered=False)
+    
+    @staticmethod
+    def remove_conversation(user1_id, user2_id):
+        """Drop all postings for a conversation (both owners)"""
+        search_index_collection.delete_many({'o': user1_id, 'c': user2_id})
+        search_index_collection.delete_many({'o': user2_id, 'c': user1_id})
+    
+    @staticmethod
+    def rebuild(batch_size=1000):
+        """Rebuild the whole index from the hot collection and every archive month"""
+        search_index_collection.delete_many({})
+        
+        sources = [messages_collection] + [db[name] for name in MessageArchive.collection_names(refresh=True)]
+        
+        indexed = 0
+        postings = []
+        for collection in sources:
+            for message in collection.find({'type': 'text'}):
+                postings.extend(MessageSearch.build_postings(message))
+                indexed += 1
+                if len(postings) >= batch_size:
+                    search_index_collection.insert_many(postings, ordered=False)
+                    postings = []
+        if postings:
+            search_index_collection.insert_many(postings, ordered=False)
+        
+        return indexed
+    
+    @staticmethod
+    def search(user_id, query, contact_id=None, cursor=None, limit=20):
+        """
+        Search a user's text messages for all terms in query (the first MAX_QUERY_TERMS).
+        Results are newest first; pass the returned cursor to get the next page,
+        which may be short (even empty) when the scan budget ran out first.
+        Returns (messages, next_cursor).
+        """
+        from bson import ObjectId
+        
+        terms = MessageSearch.tokenize(query)[:MessageSearch.MAX_QUERY_TERMS]
+        if not terms:
+            return [], None
+        
+        scope = {'o': user_id}
+        if contact_id:
+            scope['c'] = contact_id
+        
+        # Drive the scan from the rarest term (counts are capped and answered
+        # from the index) so multi-term queries touch as few postings as possible
+        if len(terms) > 1:
+            terms.sort(key=lambda term: search_index_collection.count_documents(
+                dict(scope, t=term), limit=MessageSearch.RARITY_COUNT_LIMIT))
+        
+        # Walk that term's postings newest first and intersect each batch
+        # with the remaining terms until the page is full
+        first_term, other_terms = terms[0], terms[1:]
+        upper = ObjectId(cursor) if cursor else None
+        matched = []
+        scanned = 0
+        exhausted = True
+        
+        while len(matched) <= limit:
+            if scanned == MessageSearch.MAX_SCAN_BATCHES:
+                exhausted = False
+                break
+            scanned += 1
+            
+            postings_filter = dict(scope, t=first_term)
+            if upper is not None:
+                postings_filter['m'] = {'$lt': upper}
+            
+            batch = [p['m'] for p in search_index_collection.find(
+                postings_filter, {'m': 1, '_id': 0}
+            ).sort('m', -1).limit(MessageSearch.SCAN_BATCH)]
+            
+            if not batch:
+                break
+            
+            candidates = batch
+            for term in other_terms:
+                if not candidates:
+                    break
+                found = search_index_collection.distinct('m', dict(scope, t=term, m={'$in': candidates}))
+                found = set(found)
+                candidates = [m for m in candidates if m in found]
+            
+            matched.extend(candidates)
+            upper = batch[-1]
+            
+            if len(batch) < MessageSearch.SCAN_BATCH:
+                break
+        
+        page = matched[:limit]
+        if len(matched) > limit:
+            next_cursor = str(page[-1])
+        elif not exhausted:
+            # Out of budget: continue below the last posting scanned
+            next_cursor = str(upper)
+        else:
+            next_cursor = None
+        
+        if not page:
+            return [], next_cursor
+        
+        return Message.find_by_ids(page), next_cursor
+
+
+class MessageArchive:
+    """
+    Cold tier for old messages: one collection per month (by message _id time).
+    Keeps the hot messages collection and its indexes small enough for RAM.
+    """
+    
+    _collection_names = None
+    _collection_names_at = 0
+    
+    @staticmethod
+    def collection_name(when):
+        """Archive collection name for a datetime, e.g. messages_archive_2025_01"""
+        return f"{ARCHIVE_COLLECTION_PREFIX}{when.year:04d}_{when.month:02d}"
+    
+    @staticmethod
+    def collection_names(refresh=False, max_age=None):
+        """
+        Archive collection names, newest month first (cached). Pass max_age to
+        re-list if the cached list is older than that many seconds.
+        """
+        now = time.monotonic()
+        if max_age is not None and now - MessageArchive._collection_names_at > max_age:
+            refresh = True
+        if MessageArchive._collection_names is None or refresh:
+            # Months only: the directory collection shares the prefix
+            names = db.list_collection_names(
+                filter={'name': {'$regex': f'^{ARCHIVE_COLLECTION_PREFIX}[0-9]{{4}}_[0-9]{{2}}$'}}
+            )
+            MessageArchive._collection_names = sorted(names, reverse=True)
+            MessageArchive._collection_names_at = now
+        return MessageArchive._collection_names
+    
+    @staticmethod
+    def conversation_key(user1_id, user2_id):
+        """Order-independent key for a 1:1 conversation"""
+        return ':'.join(sorted([user1_id, user2_id]))
+    
+    @staticmethod
+    def room_key(room_id):
+        """Directory key for a group room"""
+        return f"room:{room_id}"
+    
+    @staticmethod
+    def collections(key, before=None):
+        """Archive collections holding a conversation key, newest first, skipping months after `before`"""
+        entry = archive_directory_collection.find_one({'conversation': key})
+        if not entry:
+            return []
+        
+        names = sorted(entry['collections'], reverse=True)
+        if before is not None:
+            newest = MessageArchive.collection_name(before)
+            names = [name for name in names if name <= newest]
+        return [db[name] for name in names]
+    
+    @staticmethod
+    def _get_or_create(name):
+        """Get an archive collection, creating it compressed and indexed"""
+        if name not in MessageArchive.collection_names():
+            try:
+                # zstd keeps rarely-read history (inline images included) small on disk
+                db.create_collection(name, storageEngine={
+                    'wiredTiger': {'configString': 'block_compressor=zstd'}
+                })
+            except CollectionInvalid:
+                pass  # Created by another process
+            MessageArchive._create_indexes(db[name])
+            MessageArchive.collection_names(refresh=True)
+        return db[name]
+    
+    @staticmethod
+    def _create_indexes(collection):
+        collection.create_index([('sender', 1), ('recipient', 1), ('_id', -1)])
+        collection.create_index([('room', 1), ('_id', -1)],
+                                partialFilterExpression={'room': {'$exists': True}})
+    
+    @staticmethod
+    def ensure_indexes():
+        """Bring indexes of existing archive months up to date (no-op if they are)"""
+        for name in MessageArchive.collection_names(refresh=True):
+            MessageArchive._create_indexes(db[name])
+    
+    @staticmethod
+    def archive_old_messages(older_than_days=None, batch_size=500):
+        """Move messages older than the cutoff from the hot collection into monthly archives"""
+        from bson import ObjectId
+        
+        days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+        cutoff = ObjectId.from_datetime(datetime.utcnow() - timedelta(days=days))
+        
+        moved = 0
+        while True:
+            batch = list(messages_collection.find({'_id': {'$lt': cutoff}}).sort('_id', 1).limit(batch_size))
+            if not batch:
+                break
+            
+            by_month = {}
+            conversations = {}
+            for msg in batch:
+                name = MessageArchive.collection_name(msg['_id'].generation_time)
+                by_month.setdefault(name, []).append(msg)
+                if 'room' in msg:
+                    key = MessageArchive.room_key(msg['room'])
+                else:
+                    key = MessageArchive.conversation_key(msg['sender'], msg['recipient'])
+                conversations.setdefault(key, set()).add(name)
+            
+            # Copy first, delete second - a crash in between only leaves duplicates
+            # that the next run skips (same _id), never lost messages
+            for name, docs in by_month.items():
+                try:
+                    MessageArchive._get_or_create(name).insert_many(docs, ordered=False)
+                except BulkWriteError as e:
+                    if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+                        raise
+            
+            # Remember which months each conversation spans so reads skip the rest
+            archive_directory_collection.bulk_write([
+                UpdateOne({'conversation': key},
+                          {'$addToSet': {'collections': {'$each': sorted(names)}}},
+                          upsert=True)
+                for key, names in conversations.items()
+            ], ordered=False)
+            
+            messages_collection.delete_many({'_id': {'$in': [msg['_id'] for msg in batch]}})
+            moved += len(batch)
+        
+        if moved:
+            print(f"📦 Archived {moved} messages older than {days} days")
+        return moved
+    
+    @staticmethod
+    def delete_conversation(user1_id, user2_id):
+        """Delete a conversation from the archive tier"""
+        key = MessageArchive.conversation_key(user1_id, user2_id)
+        deleted = 0
+        for collection in MessageArchive.collections(key):
+            result = collection.delete_many({
+                '$or': [
+                    {'sender': user1_id, 'recipient': user2_id},
+                    {'sender': user2_id, 'recipient': user1_id}
+                ]
+            })
+            deleted += result.deleted_count
+        
+        archive_directory_collection.delete_one({'conversation': key})
+        return deleted
+
+
+class Room:
+    """
+    Group chat room with membership. Members are cached per process; callers
+    publish membership changes so other workers drop their copy (see
+    invalidation.py), and a miss re-reads before rejecting.
+    """
+    
+    # {room_id: (expires_at, frozenset of member ids)}
+    _member_cache = {}
+    
+    @staticmethod
+    def create(name, owner_id, member_ids=()):
+        """Create a room and add the owner plus initial members"""
+        room_data = {
+            'name': name,
+            'owner_id': owner_id,
+            'created_at': datetime.utcnow(),
+            'member_count': 0
+        }
+        
+        result = rooms_collection.insert_one(room_data)
+        room_data['_id'] = result.inserted_id
+        room_id = str(result.inserted_id)
+        
+        added = Room.add_members(room_id, [owner_id, *member_ids])
+        room_data['member_count'] = added
+        return room_data
+    
+    @staticmethod
+    def get(room_id):
+        """Get room by ID"""
+        from bson import ObjectId
+        return rooms_collection.find_one({'_id': ObjectId(room_id)})
+    
+    @staticmethod
+    def get_rooms_for_user(user_id):
+        """Get all rooms a user belongs to"""
+        from bson import ObjectId
+        
+        room_ids = [ObjectId(m['room_id']) for m in room_members_collection.find({'user_id': user_id}, {'room_id': 1})]
+        rooms = rooms_collection.find({'_id': {'$in': room_ids}}).sort('name', 1)
+        
+        return [{
+            'id': str(room['_id']),
+            'name': room['name'],
+            'owner_id': room['owner_id'],
+            'member_count': room.get('member_count', 0)
+        } for room in rooms]
+    
+    @staticmethod
+    def get_room_ids_for_user(user_id):
+        """Get IDs of all rooms a user belongs to"""
+        return [m['room_id'] for m in room_members_collection.find({'user_id': user_id}, {'room_id': 1})]
+    
+    @staticmethod
+    def add_members(room_id, user_ids):
+        """Add users to a room, returns how many were newly added"""
+        from bson import ObjectId
+        
+        now = datetime.utcnow()
+        result = room_members_collection.bulk_write([
+            UpdateOne({'room_id': room_id, 'user_id': user_id},
+                      {'$setOnInsert': {'joined_at': now}},
+                      upsert=True)
+            for user_id in dict.fromkeys(user_ids)
+        ], ordered=False)
+        
+        added = result.upserted_count
+        if added:
+            rooms_collection.update_one({'_id': ObjectId(room_id)}, {'$inc': {'member_count': added}})
+        
+        Room.invalidate_members(room_id)
+        return added
+    
+    @staticmethod
+    def remove_member(room_id, user_id):
+        """Remove a user from a room"""
+        from bson import ObjectId
+        
+        result = room_members_collection.delete_one({'room_id': room_id, 'user_id': user_id})
+        if result.deleted_count:
+            rooms_collection.update_one({'_id': ObjectId(room_id)}, {'$inc': {'member_count': -1}})
+        
+        Room.invalidate_members(room_id)
+        return result.deleted_count > 0
+    
+    @staticmethod
+    def invalidate_members(room_id):
+        """Drop this process' cached member set for a room"""
+        Room._member_cache.pop(room_id, None)
+    
+    @staticmethod
+    def get_member_ids(room_id, refresh=False):
+        """Get the set of member IDs (cached for ROOM_MEMBER_CACHE_SECONDS)"""
+        cached = Room._member_cache.get(room_id)
+        if cached and cached[0] > time.monotonic() and not refresh:
+            return cached[1]
+        
+        members = frozenset(m['user_id'] for m in room_members_collection.find({'room_id': room_id}, {'user_id': 1}))
+        Room._member_cache[room_id] = (time.monotonic() + ROOM_MEMBER_CACHE_SECONDS, members)
+        return members
+    
+    @staticmethod
+    def is_member(room_id, user_id):
+        """Check room membership (uses the member cache, re-reads on a miss)"""
+        if user_id in Room.get_member_ids(room_id):
+            return True
+        # Added on another worker and the invalidation hasn't arrived yet
+        return user_id in Room.get_member_ids(room_id, refresh=True)
+    
+    @staticmethod
+    def get_members(room_id, after=None, limit=50):
+        """Page through room members ordered by user ID, returns (members, next_cursor)"""
+        from bson import ObjectId
+        
+        query = {'room_id': room_id}
+        if after:
+            query['user_id'] = {'$gt': after}
+        
+        entries = list(room_members_collection.find(query).sort('user_id', 1).limit(limit + 1))
+        page = entries[:limit]
+        
+        users = users_collection.find(
+            {'_id': {'$in': [ObjectId(entry['user_id']) for entry in page]}},
+            {'username': 1, 'online': 1}
+        )
+        by_id = {str(user['_id']): user for user in users}
+        
+        members = []
+        for entry in page:
+            user = by_id.get(entry['user_id'])
+            if user:
+                members.append({
+                    'id': entry['user_id'],
+                    'username': user['username'],
+                    'online': user.get('online', False)
+                })
+        
+        next_cursor = page[-1]['user_id'] if len(entries) > limit else None
+        return members, next_cursor
 
 
 class FriendRequest:
@@ -207,7 +819,7 @@ class FriendRequest:
     
     @staticmethod
     def accept(request_id, user_id):
-        """Accept a friend request"""
+        """Accept a friend request, returns the new contact entries of both users (or None)"""
         from bson import ObjectId
         
         req = db['friend_requests'].find_one({
@@ -217,11 +829,11 @@ class FriendRequest:
         })
         
         if not req:
-            return False
+            return None
         
         # Add both as contacts
-        Contact.add_direct(req['sender_id'], req['recipient_id'])
-        Contact.add_direct(req['recipient_id'], req['sender_id'])
+        sender_entry = Contact.add_direct(req['sender_id'], req['recipient_id'])
+        recipient_entry = Contact.add_direct(req['recipient_id'], req['sender_id'])
         
         # Update request status
         db['friend_requests'].update_one(
@@ -229,7 +841,7 @@ class FriendRequest:
             {'$set': {'status': 'accepted', 'accepted_at': datetime.utcnow()}}
         )
         
-        return True
+        return {'request': req, 'sender': sender_entry, 'recipient': recipient_entry}
     
     @staticmethod
     def reject(request_id, user_id):
@@ -244,7 +856,39 @@ class FriendRequest:
 
 
 class Contact:
-    """Contact model for managing user connections"""
+    """
+    Contact model for managing user connections.
+    Every change stamps the affected entry with the next version of its owner's
+    list, so a user's list version is the highest version among its entries
+    and clients can sync only what changed. Removals are kept as tombstones.
+    """
+    
+    @staticmethod
+    def _horizon(user_id):
+        """Highest version of a user's purged tombstones (0 if none)"""
+        horizon = counters_collection.find_one({'_id': f'contacts_horizon:{user_id}'}) or {}
+        return horizon.get('value', 0)
+    
+    @staticmethod
+    def _stamp(user_id, query, update, upsert=False, fields=('version',)):
+        """
+        Apply update to one of user_id's entries together with the next version
+        of their list (set on `fields`), returns that version (None if nothing matched).
+        The version is written in the same update that changes the entry, and
+        the unique (user_id, version) index turns away a concurrent writer that
+        picked the same one, so versions commit in order: a client that has
+        seen version N has seen every change up to N.
+        """
+        while True:
+            version = Contact.get_version(user_id) + 1
+            stamped = {**update, '$set': {**update.get('$set', {}), **dict.fromkeys(fields, version)}}
+            try:
+                result = contacts_collection.update_one(query, stamped, upsert=upsert)
+            except DuplicateKeyError:
+                continue
+            if result.matched_count or result.upserted_id is not None:
+                return version
+            return None
     
     @staticmethod
     def add_direct(user_id, contact_id):
@@ -253,34 +897,46 @@ class Contact:
         if not contact_user:
             return None
         
+        if Contact.is_contact(user_id, contact_id):
+            return None
+        
         contact_data = {
             'user_id': user_id,
             'contact_id': contact_id,
             'contact_username': contact_user['username'],
-            'added_at': datetime.utcnow()
+            'added_at': datetime.utcnow(),
+            'removed': False
         }
         
-        try:
-            result = contacts_collection.insert_one(contact_data)
-            contact_data['_id'] = result.inserted_id
-            return contact_data
-        except:
-            return None
+        # Re-adding someone reuses their tombstone
+        version = Contact._stamp(
+            user_id,
+            {'user_id': user_id, 'contact_id': contact_id},
+            {'$set': contact_data},
+            upsert=True,
+            fields=('version', 'added_version')
+        )
+        contact_data['added_version'] = contact_data['version'] = version
+        contact_data['online'] = contact_user.get('online', False)
+        return contact_data
     
     @staticmethod
     def remove(user_id, contact_id):
-        """Remove a contact (one-way)"""
-        contacts_collection.delete_one({
-            'user_id': user_id,
-            'contact_id': contact_id
-        })
+        """Remove a contact (one-way), returns the new version (None if not a contact)"""
+        return Contact._stamp(
+            user_id,
+            {'user_id': user_id, 'contact_id': contact_id, 'removed': {'$ne': True}},
+            {'$set': {'removed': True, 'removed_at': datetime.utcnow()}}
+        )
     
     @staticmethod
     def remove_mutual(user1_id, user2_id):
-        """Remove contact from both users and delete all messages"""
+        """
+        Remove contact from both users and delete all messages.
+        Returns the new versions of (user1's list, user2's list).
+        """
         # Remove from both sides
-        contacts_collection.delete_one({'user_id': user1_id, 'contact_id': user2_id})
-        contacts_collection.delete_one({'user_id': user2_id, 'contact_id': user1_id})
+        versions = (Contact.remove(user1_id, user2_id), Contact.remove(user2_id, user1_id))
         
         # Delete all messages between them (using correct field names: 'sender' and 'recipient')
         result = messages_collection.delete_many({
@@ -290,49 +946,176 @@ class Contact:
             ]
         })
         
-        print(f"🗑️ Deleted {result.deleted_count} messages between users")
-        return True
+        archived = MessageArchive.delete_conversation(user1_id, user2_id)
+        MessageSearch.remove_conversation(user1_id, user2_id)
+        
+        print(f"🗑️ Deleted {result.deleted_count + archived} messages between users")
+        return versions
     
     @staticmethod
-    def get_contacts(user_id):
-        """Get all contacts for a user with real-time online status"""
-        contacts = contacts_collection.find({'user_id': user_id})
+    def _format(entries):
+        """Turn contact entries into client contacts (one users query for all)"""
+        from bson import ObjectId
+        
+        entries = list(entries)
+        users = users_collection.find(
+            {'_id': {'$in': [ObjectId(entry['contact_id']) for entry in entries]}},
+            {'username': 1, 'online': 1}
+        )
+        by_id = {str(user['_id']): user for user in users}
         
         contact_list = []
-        for contact in contacts:
-            contact_user = User.get_by_id(contact['contact_id'])
+        for entry in entries:
+            contact_user = by_id.get(entry['contact_id'])
             if contact_user:
                 contact_list.append({
-                    'id': str(contact_user['_id']),
+                    'id': entry['contact_id'],
                     'username': contact_user['username'],
                     'online': contact_user.get('online', False)
                 })
-        
         return contact_list
     
+    @staticmethod
+    def get_contacts(user_id):
+        """Get all contacts for a user with real-time online status"""
+        return Contact._format(contacts_collection.find({'user_id': user_id, 'removed': {'$ne': True}}))
+    
+    @staticmethod
+    def get_version(user_id):
+        """Current version of a user's contact list (0 if never changed)"""
+        latest = contacts_collection.find_one(
+            {'user_id': user_id, 'version': {'$type': 'number'}}, {'version': 1}, sort=[('version', -1)]
+        )
+        # Read the horizon second: purging moves it up before deleting the entries
+        return max((latest or {}).get('version', 0), Contact._horizon(user_id))
+    
+    @staticmethod
+    def get_snapshot(user_id):
+        """Full contact list with its version"""
+        version = Contact.get_version(user_id)
+        return {'snapshot': True, 'version': version, 'contacts': Contact.get_contacts(user_id)}
+    
+    @staticmethod
+    def get_changes(user_id, since_version):
+        """
+        Contacts added, removed or changed after since_version.
+        Falls back to a full snapshot if the tombstones needed were purged.
+        """
+        if since_version < Contact._horizon(user_id):
+            return Contact.get_snapshot(user_id)
+        
+        entries = list(contacts_collection.find(
+            {'user_id': user_id, 'version': {'$gt': since_version}}
+        ).sort('version', 1))
+        
+        removed = [entry['contact_id'] for entry in entries if entry.get('removed')]
+        live = [entry for entry in entries if not entry.get('removed')]
+        added_ids = {entry['contact_id'] for entry in live if entry.get('added_version', 0) > since_version}
+        
+        added, changed = [], []
+        for contact in Contact._format(live):
+            (added if contact['id'] in added_ids else changed).append(contact)
+        
+        version = max([entry['version'] for entry in entries], default=since_version)
+        return {'snapshot': False, 'version': version, 'added': added, 'changed': changed, 'removed': removed}
+    
+    @staticmethod
+    def purge_tombstones(older_than_days=30):
+        """Delete old removal tombstones (clients older than that get a full snapshot)"""
+        cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+        query = {'removed': True, 'removed_at': {'$lt': cutoff}}
+        
+        # Per-user horizon: the newest version each user is about to lose
+        newest = contacts_collection.aggregate([
+            {'$match': query},
+            {'$group': {'_id': '$user_id', 'version': {'$max': '$version'}}}
+        ])
+        horizons = [
+            UpdateOne({'_id': f"contacts_horizon:{row['_id']}"}, {'$max': {'value': row['version']}}, upsert=True)
+            for row in newest
+        ]
+        if not horizons:
+            return 0
+        
+        counters_collection.bulk_write(horizons, ordered=False)
+        return contacts_collection.delete_many(query).deleted_count
+    
     @staticmethod
     def set_online_status(user_id, online=True):
-        """Update user's online status"""
+        """Update user's online status, returns {watcher ID: new version of their list}"""
         from bson import ObjectId
         users_collection.update_one(
             {'_id': ObjectId(user_id)},
             {'$set': {'online': online, 'last_seen': datetime.utcnow()}}
         )
-        return True
+        
+        # Everyone who has this user as a contact sees it as a changed entry
+        versions = {}
+        for watcher_id in Contact.get_watchers(user_id):
+            version = Contact._stamp(
+                watcher_id,
+                {'user_id': watcher_id, 'contact_id': user_id, 'removed': {'$ne': True}},
+                {}
+            )
+            if version is not None:
+                versions[watcher_id] = version
+        return versions
+    
+    @staticmethod
+    def get_watchers(user_id):
+        """IDs of users who have this user as a contact"""
+        return [entry['user_id'] for entry in contacts_collection.find(
+            {'contact_id': user_id, 'removed': {'$ne': True}}, {'user_id': 1}
+        )]
     
     @staticmethod
     def is_contact(user_id, contact_id):
         """Check if two users are contacts"""
         return contacts_collection.find_one({
             'user_id': user_id,
-            'contact_id': contact_id
+            'contact_id': contact_id,
+            'removed': {'$ne': True}
         }) is not None
 
 
+class SocketSession:
+    """Open Socket.IO connections, shared by every worker process"""
+    
+    @staticmethod
+    def add(sid, user_id, worker_id):
+        """Record a connection (sids are unique across workers)"""
+        socket_sessions_collection.replace_one(
+            {'_id': sid},
+            {'_id': sid, 'user_id': user_id, 'worker': worker_id, 'connected_at': datetime.utcnow()},
+            upsert=True
+        )
+    
+    @staticmethod
+    def remove(sid, user_id):
+        """Forget a connection, returns True if it was the user's last one"""
+        socket_sessions_collection.delete_one({'_id': sid})
+        return socket_sessions_collection.count_documents({'user_id': user_id}, limit=1) == 0
+    
+    @staticmethod
+    def clear_worker(worker_id):
+        """
+        Drop every connection recorded by a worker (called when it starts, in case
+        its previous process died without disconnecting anyone).
+        Returns the user IDs that no longer have any connection.
+        """
+        user_ids = socket_sessions_collection.distinct('user_id', {'worker': worker_id})
+        if not user_ids:
+            return []
+        
+        socket_sessions_collection.delete_many({'worker': worker_id})
+        still_connected = set(socket_sessions_collection.distinct('user_id', {'user_id': {'$in': user_ids}}))
+        return [user_id for user_id in user_ids if user_id not in still_connected]
+
+
 # Initialize database on import
 def init_db():
     """Initialize database with indexes"""
     print(f"Connected to MongoDB: {DATABASE_NAME}")
-    print(f"Collections: users, messages, contacts")
+    print(f"Collections: users, messages (+ monthly archives), contacts, rooms, message_search_index")
 
 init_db()
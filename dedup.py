@@ -0,0 +1,78 @@
+"""
+Recent-sends window for idempotent message sends
+Clients tag every send with a client_msg_id and retry with the same ID; a
+retry that reaches the worker that stored the original is answered from
+memory (the unique index catches the rest).
+"""
+
+from collections import OrderedDict
+import os
+import re
+import threading
+import time
+
+SEND_DEDUP_SECONDS = float(os.getenv('SEND_DEDUP_SECONDS', '300'))
+SEND_DEDUP_MAX_ENTRIES = int(os.getenv('SEND_DEDUP_MAX_ENTRIES', '100000'))
+
+# UUIDs from crypto.randomUUID(), or anything similar and short
+CLIENT_MSG_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
+# Placeholder while the first attempt is still being stored
+PENDING = object()
+
+
+def valid_client_msg_id(client_msg_id):
+    return isinstance(client_msg_id, str) and CLIENT_MSG_ID_PATTERN.match(client_msg_id) is not None
+
+
+class RecentSends:
+    """(sender, client_msg_id) -> ack of the stored message, bounded by age and size"""
+    
+    def __init__(self, ttl=SEND_DEDUP_SECONDS, max_entries=SEND_DEDUP_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> [stored at, ack payload or PENDING], oldest first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def claim(self, sender_id, client_msg_id):
+        """
+        Start handling a send. Returns None if this is the first attempt seen here
+        (the caller stores it, then calls done() or release()), PENDING if the
+        first attempt is still in flight, or the ack to replay.
+        """
+        now = time.monotonic()
+        key = (sender_id, client_msg_id)
+        
+        with self._lock:
+            self._evict(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry[1]
+            self._entries[key] = [now, PENDING]
+        return None
+    
+    def done(self, sender_id, client_msg_id, ack):
+        """Remember the ack of a stored message for replays"""
+        with self._lock:
+            key = (sender_id, client_msg_id)
+            self._entries[key] = [time.monotonic(), ack]
+            self._entries.move_to_end(key)
+    
+    def release(self, sender_id, client_msg_id):
+        """The attempt failed before storing anything: let a retry try again"""
+        with self._lock:
+            entry = self._entries.get((sender_id, client_msg_id))
+            if entry is not None and entry[1] is PENDING:
+                del self._entries[(sender_id, client_msg_id)]
+    
+    def _evict(self, now):
+        entries = self._entries
+        while entries:
+            key, (stored_at, _) = next(iter(entries.items()))
+            if now - stored_at < self.ttl and len(entries) <= self.max_entries:
+                break
+            del entries[key]
+    
+    def __len__(self):
+        return len(self._entries)
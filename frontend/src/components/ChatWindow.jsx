@@ -3,13 +3,74 @@ import { useSocket } from '../context/SocketContext';
 import axios from 'axios';
 import './ChatWindow.css';
 
+const MAX_UPLOAD_SIZE = 50 * 1024 * 1024; // Matches UPLOAD_MAX_FILE_SIZE on the server
+const CHUNK_RETRIES = 3;
+const TYPING_SEND_INTERVAL = 2000; // Server throttles too, this just saves bandwidth
+const TYPING_IDLE_TIMEOUT = 3000;
+const SEND_RETRY_INTERVAL = 3000; // Resend unacknowledged messages (server drops duplicates)
+const SEND_MAX_ATTEMPTS = 5;
+
+// Same ID on every retry of a send, so the server stores it once
+const newClientMsgId = () =>
+  window.crypto?.randomUUID
+    ? window.crypto.randomUUID()
+    : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+
+// Upload a file in chunks, resuming from the server's next_index after a failure
+const uploadInChunks = async (file, recipientId) => {
+  const start = await axios.post('/api/uploads', {
+    filename: file.name,
+    size: file.size,
+    recipient_id: recipientId
+  });
+
+  const { upload_id: uploadId, chunk_size: chunkSize } = start.data;
+  const totalChunks = Math.ceil(file.size / chunkSize);
+  let index = start.data.next_index;
+  let failures = 0;
+
+  while (index < totalChunks) {
+    const chunk = file.slice(index * chunkSize, (index + 1) * chunkSize);
+    try {
+      const response = await axios.put(`/api/uploads/${uploadId}/chunks/${index}`, chunk, {
+        headers: { 'Content-Type': 'application/octet-stream' }
+      });
+      index = response.data.next_index;
+      failures = 0;
+    } catch (error) {
+      if (++failures > CHUNK_RETRIES) throw error;
+      // The chunk may have landed before the connection dropped - ask where to resume
+      const status = await axios.get(`/api/uploads/${uploadId}`);
+      index = status.data.next_index;
+    }
+  }
+
+  // Completing twice returns the first result, so a lost response is simply retried
+  for (let attempt = 0; ; attempt++) {
+    try {
+      return await axios.post(`/api/uploads/${uploadId}/complete`);
+    } catch (error) {
+      const status = error.response?.status;
+      if (attempt >= CHUNK_RETRIES || (status && status < 500)) throw error;
+    }
+  }
+};
+
 function ChatWindow({ selectedContact, onShowToast, onContactRemoved }) {
   const [messages, setMessages] = useState([]);
   const [messageInput, setMessageInput] = useState('');
   const [selectedImage, setSelectedImage] = useState(null);
   const [imagePreview, setImagePreview] = useState(null);
+  const [hasMore, setHasMore] = useState(false);
+  const [contactTyping, setContactTyping] = useState(false);
+  const [readUpTo, setReadUpTo] = useState(null);
   const messagesEndRef = useRef(null);
   const fileInputRef = useRef(null);
+  const typingSentAt = useRef(0);
+  const typingIdleTimer = useRef(null);
+  const typingClearTimer = useRef(null);
+  const lastReadSent = useRef(null);
+  const pendingSends = useRef(new Map()); // client_msg_id -> { payload, sentAt, attempts }
   
   const { socket } = useSocket();
 
@@ -18,6 +79,9 @@ function ChatWindow({ selectedContact, onShowToast, onContactRemoved }) {
     if (selectedContact && socket) {
       socket.emit('load_conversation', { contact_id: selectedContact.id });
       setMessages([]);
+      setContactTyping(false);
+      setReadUpTo(null);
+      lastReadSent.current = null;
     }
   }, [selectedContact, socket]);
 
@@ -26,16 +90,47 @@ function ChatWindow({ selectedContact, onShowToast, onContactRemoved }) {
     if (!socket) return;
 
     socket.on('conversation_loaded', (data) => {
-      setMessages(data.messages || []);
+      if (data.before) {
+        // Older page - prepend to what is already shown
+        setMessages((prev) => [...(data.messages || []), ...prev]);
+      } else {
+        setMessages(data.messages || []);
+        const read = (data.messages || []).filter((m) => m.is_mine && m.read);
+        setReadUpTo(read.length ? read[read.length - 1].id : null);
+      }
+      setHasMore(Boolean(data.has_more));
     });
 
     socket.on('message_sent', (data) => {
-      addMessage(data.content, true);
+      pendingSends.current.delete(data.client_msg_id);
+      addMessage(data.content, true, 'text', null, data.id);
+    });
+
+    socket.on('typing', (data) => {
+      if (selectedContact && data.user_id === selectedContact.id) {
+        setContactTyping(data.typing);
+        // Don't get stuck on "typing..." if the stop signal is lost
+        clearTimeout(typingClearTimer.current);
+        if (data.typing) {
+          typingClearTimer.current = setTimeout(() => setContactTyping(false), TYPING_IDLE_TIMEOUT * 2);
+        }
+      }
+    });
+
+    socket.on('read_receipt', (data) => {
+      if (selectedContact && data.reader_id === selectedContact.id) {
+        setReadUpTo(data.message_id);
+      }
     });
 
     socket.on('new_message', (data) => {
-      if (selectedContact && data.sender_id === selectedContact.id) {
-        addMessage(data.content, false);
+      if (!selectedContact) return;
+      if (data.is_mine && data.recipient_id === selectedContact.id) {
+        // Our own upload, echoed back once it is stored
+        addMessage(data.content, true, data.type, data.attachment, data.id);
+      } else if (data.sender_id === selectedContact.id) {
+        addMessage(data.content, false, data.type, data.attachment, data.id);
+        setContactTyping(false);
       }
     });
 
@@ -43,30 +138,108 @@ function ChatWindow({ selectedContact, onShowToast, onContactRemoved }) {
       socket.off('conversation_loaded');
       socket.off('message_sent');
       socket.off('new_message');
+      socket.off('typing');
+      socket.off('read_receipt');
     };
   }, [socket, selectedContact]);
 
+  // Retry sends whose ack never arrived (dropped connection, lost packet)
+  useEffect(() => {
+    if (!socket) return;
+
+    const resend = (olderThan) => {
+      const now = Date.now();
+      pendingSends.current.forEach((pending, clientMsgId) => {
+        if (now - pending.sentAt < olderThan) return;
+        if (pending.attempts >= SEND_MAX_ATTEMPTS) {
+          pendingSends.current.delete(clientMsgId);
+          onShowToast('❌ Message could not be sent', 'error');
+          return;
+        }
+        pending.attempts += 1;
+        pending.sentAt = now;
+        socket.emit('send_private_message', pending.payload);
+      });
+    };
+
+    const resendAll = () => resend(0);
+    const timer = setInterval(() => resend(SEND_RETRY_INTERVAL), SEND_RETRY_INTERVAL);
+    socket.on('connect', resendAll);
+
+    return () => {
+      clearInterval(timer);
+      socket.off('connect', resendAll);
+    };
+  }, [socket]);
+
   // Auto-scroll to bottom
   useEffect(() => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   }, [messages]);
 
-  const addMessage = (content, isMine) => {
-    setMessages((prev) => [
-      ...prev,
-      {
-        content,
-        is_mine: isMine,
-        timestamp: new Date().toISOString()
-      }
-    ]);
+  // Report the newest message we have seen (server coalesces these)
+  useEffect(() => {
+    if (!socket || !selectedContact) return;
+    const theirs = messages.filter((m) => !m.is_mine && m.id);
+    const newest = theirs.length ? theirs[theirs.length - 1].id : null;
+    if (newest && newest !== lastReadSent.current) {
+      lastReadSent.current = newest;
+      socket.emit('read_up_to', { conversation: selectedContact.id, message_id: newest });
+    }
+  }, [messages, socket, selectedContact]);
+
+  const sendTyping = (typing) => {
+    if (!socket || !selectedContact) return;
+    socket.emit('typing', { conversation: selectedContact.id, typing });
+  };
+
+  const handleInputChange = (e) => {
+    setMessageInput(e.target.value);
+
+    const now = Date.now();
+    if (now - typingSentAt.current > TYPING_SEND_INTERVAL) {
+      typingSentAt.current = now;
+      sendTyping(true);
+    }
+
+    clearTimeout(typingIdleTimer.current);
+    typingIdleTimer.current = setTimeout(() => {
+      typingSentAt.current = 0;
+      sendTyping(false);
+    }, TYPING_IDLE_TIMEOUT);
+  };
+
+  const addMessage = (content, isMine, type = 'text', attachment = null, id = null) => {
+    setMessages((prev) => {
+      // A retried send may be acknowledged more than once
+      if (id && prev.some((m) => m.id === id)) return prev;
+      return [
+        ...prev,
+        {
+          id,
+          content,
+          type,
+          attachment,
+          is_mine: isMine,
+          timestamp: new Date().toISOString()
+        }
+      ];
+    });
+  };
+
+  const loadOlderMessages = () => {
+    if (!socket || !selectedContact || messages.length === 0) return;
+    socket.emit('load_conversation', {
+      contact_id: selectedContact.id,
+      before: messages[0].id
+    });
   };
 
   const handleImageSelect = (e) => {
     const file = e.target.files[0];
     if (file) {
-      if (file.size > 5 * 1024 * 1024) { // 5MB limit
-        onShowToast('❌ Image must be smaller than 5MB', 'error');
+      if (file.size > MAX_UPLOAD_SIZE) {
+        onShowToast('❌ File must be smaller than 50MB', 'error');
         return;
       }
       
@@ -91,29 +264,30 @@ function ChatWindow({ selectedContact, onShowToast, onContactRemoved }) {
     if ((!messageInput.trim() && !selectedImage) || !selectedContact || !socket) return;
 
     if (selectedImage) {
-      // Send image message
-      const formData = new FormData();
-      formData.append('image', selectedImage);
-      formData.append('recipient_id', selectedContact.id);
-      
+      // Send image message (chunked, resumable upload)
       try {
-        const response = await axios.post('/api/messages/image', formData, {
-          headers: { 'Content-Type': 'multipart/form-data' }
-        });
+        const response = await uploadInChunks(selectedImage, selectedContact.id);
         
         if (response.data.success) {
           onShowToast('📷 Image sent!', 'success');
           removeImage();
         }
       } catch (error) {
-        onShowToast('❌ Failed to send image', 'error');
+        onShowToast(`❌ ${error.response?.data?.error || 'Failed to send image'}`, 'error');
       }
     } else {
-      // Send text message
-      socket.emit('send_private_message', {
+      // Send text message (retried until acknowledged)
+      const payload = {
         recipient_id: selectedContact.id,
-        content: messageInput.trim()
-      });
+        content: messageInput.trim(),
+        client_msg_id: newClientMsgId()
+      };
+      pendingSends.current.set(payload.client_msg_id, { payload, sentAt: Date.now(), attempts: 1 });
+      socket.emit('send_private_message', payload);
+
+      clearTimeout(typingIdleTimer.current);
+      typingSentAt.current = 0;
+      sendTyping(false);
     }
 
     setMessageInput('');
@@ -147,6 +321,12 @@ function ChatWindow({ selectedContact, onShowToast, onContactRemoved }) {
     }
   };
 
+  // Only the newest of our messages covered by the read watermark gets a marker
+  // (ObjectId hex strings sort in creation order)
+  const lastReadIndex = readUpTo
+    ? messages.reduce((found, m, i) => (m.is_mine && m.id && m.id <= readUpTo ? i : found), -1)
+    : -1;
+
   if (!selectedContact) {
     return (
       <div className="chat-window">
@@ -176,6 +356,11 @@ function ChatWindow({ selectedContact, onShowToast, onContactRemoved }) {
 
       {/* Messages Container */}
       <div className="messages-container">
+        {hasMore && (
+          <button className="btn-load-older" onClick={loadOlderMessages}>
+            Load older messages
+          </button>
+        )}
         {messages.length === 0 ? (
           <div className="no-messages">
             No messages yet. Start the conversation!
@@ -194,6 +379,10 @@ function ChatWindow({ selectedContact, onShowToast, onContactRemoved }) {
                     className="message-image"
                     onClick={() => window.open(msg.content, '_blank')}
                   />
+                ) : msg.type === 'file' ? (
+                  <a className="message-file" href={msg.content} download>
+                    📎 {msg.attachment?.filename || 'Download file'}
+                  </a>
                 ) : (
                   msg.content
                 )}
@@ -204,11 +393,15 @@ function ChatWindow({ selectedContact, onShowToast, onContactRemoved }) {
                     hour: '2-digit',
                     minute: '2-digit'
                   })}
+                  {index === lastReadIndex && ' · ✓ Read'}
                 </div>
               )}
             </div>
           ))
         )}
+        {contactTyping && (
+          <div className="typing-indicator">{selectedContact.username} is typing...</div>
+        )}
         <div ref={messagesEndRef} />
       </div>
 
@@ -236,7 +429,7 @@ function ChatWindow({ selectedContact, onShowToast, onContactRemoved }) {
               type="text"
               placeholder="Type a message..."
               value={messageInput}
-              onChange={(e) => setMessageInput(e.target.value)}
+              onChange={handleInputChange}
               onKeyPress={handleKeyPress}
               maxLength={500}
             />
@@ -24,17 +24,39 @@ export const SocketProvider = ({ children }) => {
         withCredentials: true,
         transports: ['websocket', 'polling']
       });
+      let draining = false;
 
       newSocket.on('connect', () => {
         console.log('✅ Socket connected:', newSocket.id);
         setConnected(true);
+        draining = false;
       });
 
-      newSocket.on('disconnect', () => {
+      newSocket.on('disconnect', (reason) => {
         console.log('❌ Socket disconnected');
         setConnected(false);
+        // A draining worker may drop us before our reconnect timer fires
+        if (reason === 'io server disconnect' && draining) {
+          newSocket.connect();
+        }
       });
 
+      // The server is restarting this worker: reconnect (through the load
+      // balancer, to another worker) at a random moment so clients spread out
+      newSocket.on('server_draining', (data) => {
+        draining = true;
+        const delay = Math.random() * (data?.reconnect_within || 1) * 1000;
+        setTimeout(() => {
+          if (draining) {
+            newSocket.disconnect().connect();
+          }
+        }, delay);
+      });
+
+      // Room membership changed (possibly from another tab or worker)
+      newSocket.on('room_joined', () => newSocket.emit('sync_rooms'));
+      newSocket.on('room_left', () => newSocket.emit('sync_rooms'));
+
       newSocket.on('connect_error', (error) => {
         console.error('Socket connection error:', error);
       });
@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { useAuth } from '../context/AuthContext';
 import { useSocket } from '../context/SocketContext';
 import axios from 'axios';
@@ -12,6 +12,9 @@ function Chat() {
   const [friendRequests, setFriendRequests] = useState([]);
   const [selectedContact, setSelectedContact] = useState(null);
   const [toast, setToast] = useState({ show: false, message: '', type: 'info' });
+  const contactsVersion = useRef(0);
+  const latestContactsVersion = useRef(0); // Highest version announced so far
+  const contactsSyncing = useRef(false);
   
   const { user, logout } = useAuth();
   const { socket, connected } = useSocket();
@@ -37,41 +40,106 @@ function Chat() {
       showToast(`✅ ${data.accepter_username} accepted your friend request!`, 'success');
     });
 
-    socket.on('contacts_updated', (data) => {
-      setContacts(data.contacts);
-      
-      // Update selected contact's online status if they're currently selected
-      if (selectedContact) {
-        const updatedContact = data.contacts.find(c => c.id === selectedContact.id);
-        if (updatedContact) {
-          setSelectedContact(updatedContact);
-        } else {
-          // Contact was removed
-          setSelectedContact(null);
-        }
-      }
+    // Incremental contact updates - only the changed entry is sent
+    socket.on('contact_added', (data) => {
+      applyContactChanges({ version: data.version, added: [data.contact] });
+    });
+
+    socket.on('contact_updated', (data) => {
+      applyContactChanges({ version: data.version, changed: [data.contact] });
     });
 
     socket.on('contact_removed', (data) => {
-      showToast(`${data.removed_by_username} removed you from their contacts`, 'info');
-      
-      if (selectedContact && selectedContact.id === data.removed_by_id) {
-        setSelectedContact(null);
+      applyContactChanges({ version: data.version, removed: [data.contact_id] });
+
+      // The other side removed us (our own removals come back with their ID)
+      if (data.removed_by_id === data.contact_id) {
+        showToast(`${data.removed_by_username} removed you from their contacts`, 'info');
       }
     });
 
+    socket.on('contacts_synced', (data) => {
+      contactsSyncing.current = false;
+      applyContactChanges(data, true);
+      // Events skipped while the sync was in flight
+      if (latestContactsVersion.current > contactsVersion.current) requestContactsSync();
+    });
+
+    // Catch up on anything missed while disconnected
+    const syncContacts = () => {
+      contactsSyncing.current = false;
+      requestContactsSync();
+    };
+    socket.on('connect', syncContacts);
+
     return () => {
       socket.off('friend_request_received');
       socket.off('friend_request_accepted');
-      socket.off('contacts_updated');
+      socket.off('contact_added');
+      socket.off('contact_updated');
       socket.off('contact_removed');
+      socket.off('contacts_synced');
+      socket.off('connect', syncContacts);
     };
   }, [socket, selectedContact]);
 
+  // Ask for every contact change after our version (answered with contacts_synced)
+  const requestContactsSync = () => {
+    if (!socket || contactsSyncing.current) return;
+    contactsSyncing.current = true;
+    socket.emit('contacts_sync', { since_version: contactsVersion.current });
+  };
+
+  // Apply a snapshot or a delta ({added, changed, removed}) to the contact list.
+  // Events can arrive out of order (several workers): older ones are ignored and
+  // a gap is filled by a sync instead of applying changes past a missing one.
+  const applyContactChanges = (data, fromSync = false) => {
+    const version = data.version || 0;
+    latestContactsVersion.current = Math.max(latestContactsVersion.current, version);
+
+    if (data.snapshot) {
+      if (version < contactsVersion.current) return;
+      setContacts(data.contacts);
+    } else {
+      if (version <= contactsVersion.current) return;
+      if (!fromSync && version > contactsVersion.current + 1) {
+        requestContactsSync();
+        return;
+      }
+
+      const removed = new Set(data.removed || []);
+      const upserts = [...(data.added || []), ...(data.changed || [])];
+      const byId = new Map(upserts.map((c) => [c.id, c]));
+
+      setContacts((prev) => {
+        const kept = prev
+          .filter((c) => !removed.has(c.id))
+          .map((c) => byId.get(c.id) || c);
+        const known = new Set(kept.map((c) => c.id));
+        return [...kept, ...upserts.filter((c) => !known.has(c.id) && !removed.has(c.id))];
+      });
+    }
+
+    contactsVersion.current = version;
+
+    // Keep the selected contact in sync (or clear it if they were removed)
+    if (selectedContact) {
+      if ((data.removed || []).includes(selectedContact.id) ||
+          (data.snapshot && !data.contacts.some((c) => c.id === selectedContact.id))) {
+        setSelectedContact(null);
+      } else {
+        const updated = [...(data.added || []), ...(data.changed || []), ...(data.contacts || [])]
+          .find((c) => c.id === selectedContact.id);
+        if (updated) setSelectedContact(updated);
+      }
+    }
+  };
+
   const loadContacts = async () => {
     try {
       const response = await axios.get('/api/contacts');
-      setContacts(response.data.contacts);
+      // Socket events may already be ahead of this snapshot
+      applyContactChanges({ snapshot: true, contacts: response.data.contacts, version: response.data.version });
     } catch (error) {
       console.error('Failed to load contacts:', error);
     }
@@ -0,0 +1,70 @@
+"""
+Cache invalidation between worker processes
+Per-process caches (room members) are cleared locally right away and the
+change is published over Redis, so every other worker drops its copy too.
+"""
+
+import json
+import os
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+CHANNEL = 'chat:invalidate'
+RECONNECT_SECONDS = 1
+
+
+class CacheInvalidation:
+    """Named invalidation handlers, fanned out to all workers when a Redis URL is set"""
+    
+    def __init__(self, url=None, channel=CHANNEL):
+        self.channel = channel
+        self.handlers = {}
+        self._client = None
+        if url and url.startswith('redis'):
+            if redis is None:
+                raise RuntimeError('A Redis message queue is set but the redis package is not installed')
+            self._client = redis.Redis.from_url(url)
+    
+    @property
+    def shared(self):
+        return self._client is not None
+    
+    def on(self, kind, handler):
+        """Register handler(key) for an invalidation kind"""
+        self.handlers[kind] = handler
+    
+    def publish(self, kind, key):
+        """Invalidate here, then tell the other workers"""
+        self._apply(kind, key)
+        if self._client is not None:
+            try:
+                self._client.publish(self.channel, json.dumps({'kind': kind, 'key': key, 'pid': os.getpid()}))
+            except redis.RedisError as e:
+                print(f"❌ Error publishing cache invalidation: {e}")
+    
+    def listen(self):
+        """Apply invalidations from other workers (run as a background task)"""
+        while True:
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    try:
+                        event = json.loads(message['data'])
+                    except (TypeError, ValueError):
+                        continue
+                    if event.get('pid') != os.getpid():
+                        self._apply(event.get('kind'), event.get('key'))
+            except redis.RedisError as e:
+                # Missed invalidations while disconnected: fall back to the cache TTL
+                print(f"❌ Cache invalidation listener lost Redis: {e}")
+                time.sleep(RECONNECT_SECONDS)
+    
+    def _apply(self, kind, key):
+        handler = self.handlers.get(kind)
+        if handler is not None:
+            handler(key)
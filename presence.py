@@ -0,0 +1,128 @@
+"""
+Typing indicators and read receipts
+Typing is throttled and never stored; read receipts are coalesced into one
+range update per conversation and flushed in batches.
+"""
+
+from bson import ObjectId
+from collections import OrderedDict
+import os
+import threading
+import time
+
+TYPING_THROTTLE_SECONDS = float(os.getenv('TYPING_THROTTLE_SECONDS', '2'))
+TYPING_MAX_ENTRIES = int(os.getenv('TYPING_MAX_ENTRIES', '100000'))
+READ_RECEIPT_FLUSH_SECONDS = float(os.getenv('READ_RECEIPT_FLUSH_SECONDS', '2'))
+# Distinct conversations one reader can have waiting per flush (each costs an update_many)
+READ_RECEIPT_MAX_PER_READER = int(os.getenv('READ_RECEIPT_MAX_PER_READER', '20'))
+
+
+class TypingThrottle:
+    """At most one 'started typing' signal per (user, conversation) per interval"""
+    
+    def __init__(self, interval=TYPING_THROTTLE_SECONDS, max_entries=TYPING_MAX_ENTRIES):
+        self.interval = interval
+        self.max_entries = max_entries
+        # (user_id, conversation_id) -> [last 'typing' time, forwarded], oldest first
+        self._last_sent = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def start(self, user_id, conversation_id):
+        """True if this 'typing' signal should be forwarded"""
+        now = time.monotonic()
+        key = (user_id, conversation_id)
+        
+        with self._lock:
+            entry = self._last_sent.get(key)
+            if entry is not None and now - entry[0] < self.interval:
+                return False
+            
+            self._last_sent[key] = [now, True]
+            self._last_sent.move_to_end(key)
+            
+            # Entries older than a few intervals carry no information
+            while self._last_sent:
+                oldest_key, (oldest, _) = next(iter(self._last_sent.items()))
+                if now - oldest < self.interval * 5 and len(self._last_sent) <= self.max_entries:
+                    break
+                del self._last_sent[oldest_key]
+        
+        return True
+    
+    def deny(self, user_id, conversation_id):
+        """Drop a started signal that turned out not to be allowed (stays throttled)"""
+        with self._lock:
+            entry = self._last_sent.get((user_id, conversation_id))
+            if entry is not None:
+                entry[1] = False
+    
+    def stop(self, user_id, conversation_id):
+        """
+        True if a 'stopped typing' signal should be forwarded (a start was sent).
+        The start time is kept, so alternating start/stop stays throttled.
+        """
+        with self._lock:
+            entry = self._last_sent.get((user_id, conversation_id))
+            if entry is None or not entry[1]:
+                return False
+            entry[1] = False
+            return True
+
+
+class ReadReceiptBuffer:
+    """
+    Keeps only the highest read watermark per (reader, contact) until the next
+    flush, so scrolling through 100 messages costs one update_many, not 100.
+    """
+    
+    def __init__(self, mark_read_up_to, on_flushed, max_per_reader=READ_RECEIPT_MAX_PER_READER):
+        # mark_read_up_to(reader_id, contact_id, message_id) -> number of messages updated
+        # on_flushed(reader_id, contact_id, message_id) -> notify the other participant
+        self.mark_read_up_to = mark_read_up_to
+        self.on_flushed = on_flushed
+        self.max_per_reader = max_per_reader
+        self._pending = {}
+        # reader_id -> number of conversations in _pending
+        self._per_reader = {}
+        self._lock = threading.Lock()
+    
+    def add(self, reader_id, contact_id, message_id):
+        """Record that reader has seen everything up to message_id from contact"""
+        if not ObjectId.is_valid(message_id):
+            return False
+        watermark = ObjectId(message_id)
+        
+        with self._lock:
+            key = (reader_id, contact_id)
+            current = self._pending.get(key)
+            if current is None:
+                # Bounds the writes one client can cause per flush
+                if self._per_reader.get(reader_id, 0) >= self.max_per_reader:
+                    return False
+                self._per_reader[reader_id] = self._per_reader.get(reader_id, 0) + 1
+            if current is None or watermark > current:
+                self._pending[key] = watermark
+        return True
+    
+    def flush(self):
+        """Write all pending watermarks, returns how many conversations were flushed"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._per_reader = {}
+        
+        flushed = 0
+        for (reader_id, contact_id), watermark in pending.items():
+            try:
+                updated = self.mark_read_up_to(reader_id, contact_id, watermark)
+            except Exception as e:
+                print(f"❌ Error flushing read receipts: {e}")
+                continue
+            
+            # Nothing changed means already read (or not their conversation): stay quiet
+            if updated:
+                self.on_flushed(reader_id, contact_id, str(watermark))
+                flushed += 1
+        return flushed
+    
+    def __len__(self):
+        return len(self._pending)
@@ -0,0 +1,231 @@
+"""
+Rate limiting for socket events and REST endpoints
+Token buckets keyed per user or per IP, kept in process or shared through Redis
+"""
+
+from flask import request, session, jsonify
+from flask_socketio import emit
+from collections import OrderedDict
+from functools import wraps
+import math
+import os
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Default limits: name -> (burst capacity, seconds to refill the full burst)
+DEFAULT_LIMITS = {
+    'connect': (10, 60),
+    'login': (10, 60),              # per IP
+    'login_username': (5, 300),     # per username and IP, before any bcrypt work
+    'signup': (5, 3600),
+    'user_search': (20, 10),
+    'message_search': (10, 10),
+    'friend_request': (20, 600),
+    'contacts': (30, 60),
+    'image_upload': (10, 60),
+    'upload': (30, 60),
+    'upload_chunk': (120, 10),
+    'file_download': (120, 60),
+    'rooms': (30, 60),
+    'load_conversation': (20, 10),
+    'load_room_history': (20, 10),
+    'send_private_message': (30, 10),
+    'send_room_message': (30, 10),
+    'typing': (30, 10),
+    'read_up_to': (30, 10),
+}
+
+# Idle buckets are dropped after this long (must exceed the slowest refill,
+# so an evicted bucket would have been full anyway)
+IDLE_SECONDS = int(os.getenv('RATE_LIMIT_IDLE_SECONDS', '3600'))
+MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000'))
+
+
+def parse_limits(spec):
+    """
+    Parse overrides like "login=5/60,send_private_message=50/10"
+    (burst capacity / seconds to refill it)
+    """
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, value = item.partition('=')
+        capacity, _, period = value.partition('/')
+        limits[name.strip()] = (int(capacity), float(period or 1))
+    return limits
+
+
+class TokenBucketLimiter:
+    """In-process token buckets: O(1) memory per active key, idle keys evicted"""
+    
+    def __init__(self, idle_seconds=IDLE_SECONDS, max_keys=MAX_KEYS):
+        self.idle_seconds = idle_seconds
+        self.max_keys = max_keys
+        # key -> [tokens, last_update], least recently used first
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def hit(self, key, capacity, rate):
+        """Take one token, returns (allowed, retry_after_seconds)"""
+        now = time.monotonic()
+        
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [float(capacity), now]
+                self._buckets[key] = bucket
+            else:
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+                self._buckets.move_to_end(key)
+            
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                allowed, retry_after = True, 0.0
+            else:
+                allowed, retry_after = False, (1 - bucket[0]) / rate
+            
+            self._evict(now)
+        
+        return allowed, retry_after
+    
+    def _evict(self, now):
+        """Drop idle buckets from the LRU end (amortized O(1) per hit)"""
+        buckets = self._buckets
+        while buckets:
+            key, (tokens, last_update) = next(iter(buckets.items()))
+            if now - last_update < self.idle_seconds and len(buckets) <= self.max_keys:
+                break
+            del buckets[key]
+    
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RedisTokenBucketLimiter:
+    """
+    Token buckets in Redis, shared by every worker process.
+    Fails open: while Redis is unreachable requests are allowed (and the
+    outage is logged) rather than every limited route returning 500.
+    """
+    
+    ERROR_LOG_SECONDS = 10
+    
+    # Refill, take a token and expire the key once it would be full again
+    SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(retry_after)}
+"""
+
+    def __init__(self, url, prefix='ratelimit:'):
+        if redis is None:
+            raise RuntimeError('RATE_LIMIT_REDIS_URL is set but the redis package is not installed')
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+        self._error_logged_at = None
+    
+    def hit(self, key, capacity, rate):
+        """Take one token, returns (allowed, retry_after_seconds)"""
+        try:
+            allowed, retry_after = self._script(keys=[self.prefix + key], args=[capacity, rate])
+        except redis.RedisError as e:
+            now = time.monotonic()
+            if self._error_logged_at is None or now - self._error_logged_at >= self.ERROR_LOG_SECONDS:
+                self._error_logged_at = now
+                print(f"❌ Rate limit backend unavailable, allowing requests: {e}")
+            return True, 0.0
+        return bool(allowed), float(retry_after)
+
+
+class RateLimiter:
+    """Named limits on top of a token bucket backend"""
+    
+    def __init__(self, limits=None, backend=None):
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        # An empty TokenBucketLimiter is falsy (__len__), so test for None
+        self.backend = backend if backend is not None else TokenBucketLimiter()
+    
+    def allow(self, name, identity):
+        """Check the named limit for an identity, returns (allowed, retry_after_seconds)"""
+        capacity, period = self.limits[name]
+        return self.backend.hit(f'{name}:{identity}', capacity, capacity / period)
+
+
+def create_limiter():
+    """Build the limiter from RATE_LIMITS / RATE_LIMIT_REDIS_URL"""
+    limits = parse_limits(os.getenv('RATE_LIMITS', ''))
+    redis_url = os.getenv('RATE_LIMIT_REDIS_URL')
+    backend = RedisTokenBucketLimiter(redis_url) if redis_url else TokenBucketLimiter()
+    return RateLimiter(limits, backend)
+
+
+limiter = create_limiter()
+
+
+def client_ip():
+    """Remote address of the current request"""
+    return request.remote_addr or 'unknown'
+
+
+def request_identity(by):
+    """
+    Identity to limit on. Users are read from the session cookie
+    (no user_loader / DB hit); anonymous requests fall back to the IP.
+    """
+    if by == 'user':
+        user_id = session.get('_user_id')
+        if user_id:
+            return f'user:{user_id}'
+    return f'ip:{client_ip()}'
+
+
+def rate_limited(name, by='user'):
+    """Limit a Flask route, place above @login_required so rejects skip all work"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            allowed, retry_after = limiter.allow(name, request_identity(by))
+            if not allowed:
+                response = jsonify({'error': 'Too many requests, slow down'})
+                response.headers['Retry-After'] = str(math.ceil(retry_after))
+                return response, 429
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def rate_limited_event(name, by='user'):
+    """Limit a Socket.IO event handler, rejected events get a 'rate_limited' emit"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            allowed, retry_after = limiter.allow(name, request_identity(by))
+            if not allowed:
+                emit('rate_limited', {'event': name, 'retry_after': round(retry_after, 2)})
+                return None
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
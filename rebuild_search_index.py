@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""
+Rebuild the message search index
+Only messages sent after search was deployed are indexed as they arrive, so
+run this once to backfill existing history (hot collection and archives), or
+any time the index needs repairing. Searches return partial results while it
+runs; messages sent during the rebuild may be indexed twice, so prefer a quiet
+moment.
+
+Usage: python rebuild_search_index.py [--batch-size 1000]
+       docker-compose exec web python rebuild_search_index.py
+"""
+
+import argparse
+import time
+
+from database import MessageSearch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the message search index from all stored messages')
+    parser.add_argument('--batch-size', type=int, default=1000, help='postings per insert')
+    args = parser.parse_args()
+
+    print("🔎 Rebuilding message search index...")
+    began = time.perf_counter()
+    indexed = MessageSearch.rebuild(batch_size=args.batch_size)
+    print(f"✅ Indexed {indexed:,} messages in {time.perf_counter() - began:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
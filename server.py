@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+"""
+Production launcher: several worker processes behind a sticky load balancer
+Each worker is one single-threaded eventlet process (one core). The supervisor
+owns the public port and pins every Socket.IO session to the worker that
+created it: workers put their number in front of the session IDs they hand
+out, and the balancer reads it back from the `sid=` query parameter.
+
+Usage: WEB_WORKERS=4 SOCKETIO_MESSAGE_QUEUE=redis://localhost:6379/0 python server.py
+Signals: SIGTERM/SIGINT drain the workers and stop, SIGHUP restarts them one by one
+"""
+
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import os
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit, parse_qs
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+SID_SEPARATOR = '.'
+MAX_HEAD_SIZE = 64 * 1024
+PIPE_BUFFER_SIZE = 64 * 1024
+WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', '9100'))
+DRAIN_SECONDS = int(os.getenv('DRAIN_SECONDS', '20'))
+RESTART_BACKOFF_SECONDS = 1
+# Proxies in front of the balancer (ngrok, a host reverse proxy) whose
+# X-Forwarded-* chain is kept; with 0 whatever the client sent is dropped
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+
+# Replaced on every request, the balancer sets (or appends to) its own
+FORWARDED_HEADERS = (b'x-forwarded-for', b'x-forwarded-proto')
+
+UNAVAILABLE = (b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n'
+               b'Retry-After: 1\r\nConnection: close\r\n\r\n')
+BAD_REQUEST = b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+# Worker process
+
+def run_worker(index, port):
+    """Serve the app on a local port, draining cleanly on SIGTERM"""
+    import app_with_auth as chat
+    
+    # Engine.IO session IDs start with our worker number so the balancer can
+    # send every later request of the session back here
+    eio = chat.socketio.server.eio
+    generate_id = eio.generate_id
+    eio.generate_id = lambda: f'{index}{SID_SEPARATOR}{generate_id()}'
+    
+    def drain_and_exit():
+        chat.drain_connections(DRAIN_SECONDS)
+        print(f"👋 Worker {index} drained")
+        sys.stdout.flush()
+        os._exit(0)
+    
+    def on_sigterm(signum, frame):
+        if not chat.draining.is_set():
+            eventlet.spawn(drain_and_exit)
+    
+    signal.signal(signal.SIGTERM, on_sigterm)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the supervisor, which drains us
+    
+    chat.start_worker(primary=index == 0)
+    print(f"🧵 Worker {index} (pid {os.getpid()}) on 127.0.0.1:{port}")
+    chat.socketio.run(chat.app, host='127.0.0.1', port=port,
+                      debug=False, use_reloader=False, log_output=False)
+
+
+# Supervisor and load balancer
+
+class Worker:
+    """A worker process as seen by the supervisor"""
+    
+    def __init__(self, index, port):
+        self.index = index
+        self.port = port
+        self.process = None
+        self.ready = False
+        self.draining = False
+        self.connections = 0
+        self.restarts = 0
+    
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+    
+    @property
+    def available(self):
+        """Can take new sessions"""
+        return self.alive and self.ready and not self.draining
+
+
+class Supervisor:
+    """Starts N workers, restarts the ones that die and balances connections"""
+    
+    def __init__(self, host, port, worker_count, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.workers = [Worker(i, WORKER_BASE_PORT + i) for i in range(worker_count)]
+        self.stopping = False
+        self.restart_requested = False
+        self.listener = None
+    
+    # Processes
+    
+    def spawn(self, worker):
+        env = dict(os.environ,
+                   WORKER_ID=f"{os.getenv('NODE_NAME', socket.gethostname())}-{worker.index}",
+                   TRUST_PROXY_HEADERS='true')
+        worker.ready = False
+        worker.draining = False
+        worker.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker', str(worker.index), '--port', str(worker.port)],
+            env=env
+        )
+    
+    def check_ready(self, worker):
+        """A worker is ready once its port accepts connections"""
+        try:
+            eventlet.connect(('127.0.0.1', worker.port)).close()
+            worker.ready = True
+            print(f"✅ Worker {worker.index} ready")
+        except OSError:
+            pass
+    
+    def drain(self, worker):
+        """Stop routing new sessions to a worker and ask it to hand its clients over"""
+        worker.draining = True
+        if worker.alive:
+            worker.process.send_signal(signal.SIGTERM)
+    
+    def wait_for_exit(self, worker, timeout):
+        deadline = time.monotonic() + timeout
+        while worker.alive and time.monotonic() < deadline:
+            eventlet.sleep(0.2)
+        if worker.alive:
+            print(f"⚠️  Worker {worker.index} did not drain in time, killing it")
+            worker.process.kill()
+            worker.process.wait()
+    
+    def rolling_restart(self):
+        """Replace workers one at a time; the others absorb the reconnecting clients"""
+        print("🔄 Rolling restart")
+        for worker in self.workers:
+            if self.stopping:
+                return
+            self.drain(worker)
+            self.wait_for_exit(worker, DRAIN_SECONDS + 10)
+            self.spawn(worker)
+            while not worker.ready and worker.alive and not self.stopping:
+                self.check_ready(worker)
+                eventlet.sleep(0.2)
+    
+    def monitor(self):
+        """Restart crashed workers and mark started ones ready"""
+        while not self.stopping:
+            if self.restart_requested:
+                self.restart_requested = False
+                self.rolling_restart()
+                continue
+            
+            for worker in self.workers:
+                if worker.draining:
+                    continue
+                if not worker.alive:
+                    print(f"💥 Worker {worker.index} exited ({worker.process.returncode}), restarting")
+                    worker.restarts += 1
+                    eventlet.sleep(RESTART_BACKOFF_SECONDS)
+                    self.spawn(worker)
+                elif not worker.ready:
+                    self.check_ready(worker)
+            eventlet.sleep(0.5)
+    
+    def stop(self):
+        """Stop accepting, drain every worker in parallel and wait for them"""
+        self.stopping = True
+        if self.listener is not None:
+            self.listener.close()
+        print(f"🛑 Stopping, draining workers for up to {DRAIN_SECONDS}s")
+        for worker in self.workers:
+            self.drain(worker)
+        pool = eventlet.GreenPool()
+        for worker in self.workers:
+            pool.spawn(self.wait_for_exit, worker, DRAIN_SECONDS + 10)
+        pool.waitall()
+    
+    # Routing
+    
+    def pick(self, target):
+        """Worker for a request target: the session's owner, else the least loaded"""
+        sid = parse_qs(urlsplit(target).query).get('sid', [''])[0]
+        prefix, separator, _ = sid.partition(SID_SEPARATOR)
+        if separator and prefix.isdigit() and int(prefix) < len(self.workers):
+            worker = self.workers[int(prefix)]
+            # A draining worker still serves the sessions it owns
+            if worker.alive:
+                return worker
+        
+        candidates = [worker for worker in self.workers if worker.available]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda worker: worker.connections)
+    
+    def serve(self):
+        self.listener = eventlet.listen((self.host, self.port))
+        scheme = 'https' if self.ssl_context else 'http'
+        print(f"⚖️  Balancing {len(self.workers)} workers on {scheme}://{self.host}:{self.port}")
+        
+        pool = eventlet.GreenPool(100000)
+        while not self.stopping:
+            try:
+                client, address = self.listener.accept()
+            except OSError:
+                break  # Listener closed by stop()
+            pool.spawn_n(self.handle, client, address)
+    
+    def handle(self, client, address):
+        """Proxy one client connection (TLS is terminated here)"""
+        connection = ProxiedConnection(self, client, address)
+        try:
+            if self.ssl_context:
+                connection.client = self.ssl_context.wrap_socket(client, server_side=True)
+            connection.run()
+        except (OSError, ssl.SSLError):
+            pass
+        finally:
+            connection.close()
+
+
+class ProxiedConnection:
+    """
+    Forwards HTTP requests from one client connection, choosing a worker per
+    request (keep-alive connections may carry requests for several sessions).
+    After a WebSocket upgrade the connection becomes a plain byte pipe.
+    """
+    
+    def __init__(self, supervisor, client, address):
+        self.supervisor = supervisor
+        self.client = client
+        self.client_ip = address[0].encode()
+        self.worker = None
+        self.backend = None
+    
+    def run(self):
+        reader = self.client.makefile('rb')
+        proto = b'https' if self.supervisor.ssl_context else b'http'
+        
+        while True:
+            head = read_head(reader)
+            if head is None:
+                return
+            if head is False:
+                self.client.sendall(BAD_REQUEST)
+                return
+            
+            request_line, headers = head
+            parts = request_line.split(b' ')
+            if len(parts) != 3:
+                self.client.sendall(BAD_REQUEST)
+                return
+            
+            worker = self.supervisor.pick(parts[1].decode('latin-1'))
+            if worker is None:
+                self.client.sendall(UNAVAILABLE)
+                return
+            if worker is not self.worker:
+                self.connect(worker)
+            
+            lines = [request_line]
+            lines += [line for line in headers if line.split(b':', 1)[0].strip().lower() not in FORWARDED_HEADERS]
+            lines += forwarded_headers(headers, self.client_ip, proto)
+            self.backend.sendall(b'\r\n'.join(lines) + b'\r\n\r\n')
+            
+            fields = header_fields(headers)
+            if fields.get(b'upgrade', b'').lower() == b'websocket' or b'chunked' in fields.get(b'transfer-encoding', b'').lower():
+                # Nothing left to route: pipe the rest of the connection as is
+                pipe(reader, self.backend)
+                return
+            
+            remaining = int(fields.get(b'content-length', b'0') or 0)
+            while remaining > 0:
+                data = reader.read1(min(PIPE_BUFFER_SIZE, remaining))
+                if not data:
+                    return
+                self.backend.sendall(data)
+                remaining -= len(data)
+    
+    def connect(self, worker):
+        """Switch this client to another worker's backend connection"""
+        self.release()
+        self.backend = eventlet.connect(('127.0.0.1', worker.port))
+        self.worker = worker
+        worker.connections += 1
+        eventlet.spawn_n(self.pump, self.backend)
+    
+    def pump(self, backend):
+        """Copy responses back to the client until the worker closes"""
+        try:
+            while True:
+                data = backend.recv(PIPE_BUFFER_SIZE)
+                if not data:
+                    break
+                self.client.sendall(data)
+        except OSError:
+            pass
+        
+        # Worker closed the connection it is currently serving: so does the client
+        if backend is self.backend:
+            try:
+                self.client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+    
+    def release(self):
+        if self.backend is not None:
+            self.worker.connections -= 1
+            try:
+                self.backend.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            self.backend = None
+            self.worker = None
+    
+    def close(self):
+        self.release()
+        try:
+            self.client.close()
+        except OSError:
+            pass
+
+
+def read_head(reader):
+    """Request line and header lines, None at EOF, False if malformed or too large"""
+    request_line = reader.readline(MAX_HEAD_SIZE)
+    while request_line in (b'\r\n', b'\n'):
+        request_line = reader.readline(MAX_HEAD_SIZE)  # Stray CRLF between requests
+    if not request_line:
+        return None
+    if not request_line.endswith(b'\n'):
+        return False
+    
+    headers = []
+    size = len(request_line)
+    while True:
+        line = reader.readline(MAX_HEAD_SIZE)
+        size += len(line)
+        if not line.endswith(b'\n') or size > MAX_HEAD_SIZE:
+            return False
+        line = line.rstrip(b'\r\n')
+        if not line:
+            return request_line.rstrip(b'\r\n'), headers
+        headers.append(line)
+
+
+def header_fields(headers):
+    fields = {}
+    for line in headers:
+        name, _, value = line.partition(b':')
+        fields[name.strip().lower()] = value.strip()
+    return fields
+
+
+def forwarded_headers(headers, client_ip, proto):
+    """X-Forwarded-* for the worker, appended to the upstream chain if proxies are trusted"""
+    chains = {name: [] for name in FORWARDED_HEADERS}
+    if TRUSTED_PROXY_HOPS:
+        for line in headers:
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            if name in chains:
+                chains[name].append(value.strip())
+    return [
+        b'X-Forwarded-For: ' + b', '.join(chains[b'x-forwarded-for'] + [client_ip]),
+        b'X-Forwarded-Proto: ' + b', '.join(chains[b'x-forwarded-proto'] + [proto])
+    ]
+
+
+def pipe(reader, backend):
+    while True:
+        data = reader.read1(PIPE_BUFFER_SIZE)
+        if not data:
+            break
+        backend.sendall(data)
+
+
+def build_ssl_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(os.getenv('SSL_CERTFILE', 'cert.pem'), os.getenv('SSL_KEYFILE', 'key.pem'))
+    return context
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the chat server with several worker processes')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_WORKERS', default_workers())))
+    parser.add_argument('--host', default=os.getenv('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', '8080')))
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker is not None:
+        run_worker(args.worker, args.port)
+        return
+    
+    workers = max(args.workers, 1)
+    if workers > 1 and not os.getenv('SOCKETIO_MESSAGE_QUEUE'):
+        # Without a message queue an emit only reaches clients of the emitting worker
+        print("⚠️  SOCKETIO_MESSAGE_QUEUE is not set, running a single worker")
+        workers = 1
+    if workers > 1 and not os.getenv('RATE_LIMIT_REDIS_URL') and os.getenv('SOCKETIO_MESSAGE_QUEUE', '').startswith('redis'):
+        # Share rate limits between workers instead of allowing N times the limit
+        os.environ['RATE_LIMIT_REDIS_URL'] = os.environ['SOCKETIO_MESSAGE_QUEUE']
+    
+    use_ssl = os.getenv('USE_SSL', 'true').lower() == 'true'
+    supervisor = Supervisor(args.host, args.port, workers, build_ssl_context() if use_ssl else None)
+    
+    for worker in supervisor.workers:
+        supervisor.spawn(worker)
+    
+    def on_stop(signum, frame):
+        if not supervisor.stopping:
+            eventlet.spawn_n(supervisor.stop)
+    
+    def on_hup(signum, frame):
+        supervisor.restart_requested = True
+    
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGHUP, on_hup)
+    
+    monitor = eventlet.spawn(supervisor.monitor)
+    supervisor.serve()
+    
+    # serve() returns once stop() closed the listener; wait for the drain to finish
+    while any(worker.alive for worker in supervisor.workers):
+        eventlet.sleep(0.5)
+    monitor.kill()
+    print("👋 All workers stopped")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""
+Static file serving for the React build (frontend/dist)
+Files are loaded into an in-memory manifest at startup, with gzip/brotli
+variants precompressed once, so requests never touch the filesystem.
+"""
+
+from flask import Response
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Vite puts content-hashed files here, they never change under the same name
+HASHED_PREFIX = 'assets/'
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'no-cache'
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json',
+                      'application/xml', 'image/svg+xml', 'application/manifest+json')
+MIN_COMPRESS_SIZE = 512
+
+
+class StaticAsset:
+    """One file from the build with its precompressed variants"""
+    
+    def __init__(self, path, data, mimetype):
+        self.path = path
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(data).hexdigest()[:20]
+        self.immutable = path.startswith(HASHED_PREFIX)
+        # encoding -> bytes ('identity' is always present)
+        self.variants = {'identity': data}
+    
+    def add_variant(self, encoding, data):
+        """Keep a compressed variant only if it actually saves bytes"""
+        if data is not None and len(data) < len(self.variants['identity']):
+            self.variants[encoding] = data
+
+
+class StaticAssets:
+    """In-memory manifest of a build directory"""
+    
+    def __init__(self, root):
+        self.root = root
+        self.assets = {}
+    
+    def load(self):
+        """Walk the build directory and load every file (call once at startup)"""
+        assets = {}
+        if not os.path.isdir(self.root):
+            print(f"⚠️  Frontend build not found at {self.root} (run npm run build)")
+            self.assets = assets
+            return self
+        
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(('.gz', '.br')):
+                    continue  # Picked up below as variants of the original
+                
+                full_path = os.path.join(dirpath, filename)
+                path = os.path.relpath(full_path, self.root).replace(os.sep, '/')
+                assets[path] = self._load_asset(full_path, path)
+        
+        self.assets = assets
+        total = sum(len(asset.variants['identity']) for asset in assets.values())
+        print(f"📦 Loaded {len(assets)} static files ({total // 1024} KB) from {self.root}")
+        return self
+    
+    def _load_asset(self, full_path, path):
+        with open(full_path, 'rb') as f:
+            data = f.read()
+        
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        asset = StaticAsset(path, data, mimetype)
+        
+        if len(data) >= MIN_COMPRESS_SIZE and mimetype.startswith(COMPRESSIBLE_TYPES):
+            # Prefer variants shipped next to the file (e.g. from a build plugin)
+            asset.add_variant('br', self._read_sibling(full_path + '.br') or
+                              (brotli.compress(data, quality=11) if brotli else None))
+            asset.add_variant('gzip', self._read_sibling(full_path + '.gz') or
+                              gzip.compress(data, compresslevel=9, mtime=0))
+        return asset
+    
+    @staticmethod
+    def _read_sibling(path):
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                return f.read()
+        return None
+    
+    def get(self, path):
+        """Look up a file by its path relative to the build root"""
+        return self.assets.get(path)
+    
+    def serve(self, asset, request):
+        """Build the response: best encoding, cache headers, 304 on matching ETag"""
+        encoding = choose_encoding(request.headers.get('Accept-Encoding', ''), asset.variants)
+        etag = asset.etag if encoding == 'identity' else f'{asset.etag}-{encoding}'
+        
+        headers = {
+            'ETag': f'"{etag}"',
+            'Cache-Control': IMMUTABLE_CACHE if asset.immutable else REVALIDATE_CACHE,
+            'Vary': 'Accept-Encoding',
+        }
+        
+        if etag_matches(request.headers.get('If-None-Match', ''), etag):
+            return Response(status=304, headers=headers)
+        
+        body = asset.variants[encoding]
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        
+        response = Response(body, mimetype=asset.mimetype, headers=headers)
+        response.direct_passthrough = True
+        return response
+
+
+def choose_encoding(accept_encoding, variants):
+    """Pick br, then gzip, then identity based on the Accept-Encoding header"""
+    accepted = set()
+    refused = set()  # q=0: never sent, even if '*' is accepted
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        (accepted if quality > 0 else refused).add(name.strip().lower())
+    
+    for encoding in ('br', 'gzip'):
+        if encoding in variants and encoding not in refused and (encoding in accepted or '*' in accepted):
+            return encoding
+    return 'identity'
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against our ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate.strip('"') == etag:
+            return True
+    return False
@@ -0,0 +1,301 @@
+"""
+Chunked, resumable file uploads
+Chunks are streamed straight to disk and hashed incrementally, so a worker
+never holds more than one read buffer of an upload in memory.
+"""
+
+from datetime import datetime
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(1024 * 1024)))             # 1MB
+UPLOAD_MAX_FILE_SIZE = int(os.getenv('UPLOAD_MAX_FILE_SIZE', str(50 * 1024 * 1024)))  # 50MB
+UPLOAD_EXPIRE_SECONDS = int(os.getenv('UPLOAD_EXPIRE_SECONDS', str(24 * 3600)))
+READ_BUFFER_SIZE = 64 * 1024
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+FILE_EXTENSIONS = {'pdf', 'txt', 'zip', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'mp3', 'mp4', 'mov'}
+
+ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadError(Exception):
+    """Upload request that cannot be accepted (message is safe to show to clients)"""
+    
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class UploadStore:
+    """
+    Upload sessions on disk: <root>/partial/<id>/{meta.json,data.part}
+    Finished files: <root>/files/<id>.<ext> with <id>.json (owner, recipient)
+    """
+    
+    def __init__(self, root):
+        self.root = root
+        self.partial_dir = os.path.join(root, 'partial')
+        self.files_dir = os.path.join(root, 'files')
+        os.makedirs(self.partial_dir, exist_ok=True)
+        os.makedirs(self.files_dir, exist_ok=True)
+        # upload_id -> (bytes hashed, sha256 state), rebuilt from disk if lost or stale
+        self._hashers = {}
+    
+    # Upload sessions
+    
+    def create(self, owner_id, recipient_id, filename, size, sha256=None):
+        """Start an upload session, returns its metadata"""
+        ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+        if ext not in IMAGE_EXTENSIONS and ext not in FILE_EXTENSIONS:
+            raise UploadError('File type not allowed')
+        if size <= 0 or size > UPLOAD_MAX_FILE_SIZE:
+            raise UploadError(f'File must be between 1 byte and {UPLOAD_MAX_FILE_SIZE // (1024 * 1024)}MB', 413)
+        if sha256 is not None and not re.match(r'^[0-9a-f]{64}$', sha256):
+            raise UploadError('Invalid sha256')
+        
+        upload_id = uuid.uuid4().hex
+        meta = {
+            'upload_id': upload_id,
+            'owner_id': owner_id,
+            'recipient_id': recipient_id,
+            'filename': os.path.basename(filename)[:255],
+            'ext': ext,
+            'kind': 'image' if ext in IMAGE_EXTENSIONS else 'file',
+            'size': size,
+            'sha256': sha256,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+            'received': 0,
+            'created_at': datetime.utcnow().isoformat()
+        }
+        
+        os.makedirs(self._session_dir(upload_id))
+        open(self._data_path(upload_id), 'wb').close()
+        self._save_meta(meta)
+        self._hashers[upload_id] = (0, hashlib.sha256())
+        return meta
+    
+    def load(self, upload_id, owner_id):
+        """Get an upload session owned by owner_id, or None"""
+        if not ID_PATTERN.match(upload_id or ''):
+            return None
+        try:
+            with open(self._meta_path(upload_id)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return meta if meta['owner_id'] == owner_id else None
+    
+    @staticmethod
+    def status(meta):
+        """Resume point for the client"""
+        return {
+            'upload_id': meta['upload_id'],
+            'size': meta['size'],
+            'chunk_size': meta['chunk_size'],
+            'received': meta['received'],
+            'next_index': -(-meta['received'] // meta['chunk_size']),  # ceil, last chunk may be short
+            'complete': meta['received'] == meta['size']
+        }
+    
+    def write_chunk(self, meta, index, stream):
+        """
+        Stream one chunk from `stream` to disk. Chunks must arrive in order;
+        re-sending an already stored chunk is a no-op, so retries are safe.
+        """
+        upload_id = meta['upload_id']
+        chunk_size = meta['chunk_size']
+        offset = index * chunk_size
+        expected = min(chunk_size, meta['size'] - offset)
+        
+        if index < 0 or expected <= 0:
+            raise UploadError('Chunk index out of range')
+        
+        try:
+            data_file = open(self._data_path(upload_id), 'r+b')
+        except FileNotFoundError:
+            # Completed or discarded since the caller loaded meta
+            raise UploadError('Upload not found', 404)
+        
+        with data_file:
+            # One writer per upload, across workers too
+            fcntl.flock(data_file, fcntl.LOCK_EX)
+            
+            # Re-read under the lock, another request may have advanced it
+            meta = self.load(upload_id, meta['owner_id'])
+            if meta is None:
+                raise UploadError('Upload not found', 404)
+            
+            if offset < meta['received']:
+                self._drain(stream)
+                return meta
+            if offset > meta['received']:
+                raise UploadError('Chunk out of order, resume from next_index', 409)
+            
+            hasher = self._hasher(upload_id, meta['received']).copy()
+            data_file.seek(offset)
+            written = 0
+            
+            try:
+                while True:
+                    block = stream.read(READ_BUFFER_SIZE)
+                    if not block:
+                        break
+                    written += len(block)
+                    if written > expected:
+                        raise UploadError('Chunk larger than expected', 413)
+                    data_file.write(block)
+                    hasher.update(block)
+                
+                if written != expected:
+                    raise UploadError('Incomplete chunk, please retry')
+            except Exception:
+                # Dropped connection or bad chunk: forget the partial bytes
+                data_file.truncate(offset)
+                raise
+            
+            data_file.flush()
+            os.fsync(data_file.fileno())
+            
+            meta['received'] = offset + written
+            self._save_meta(meta)
+            self._hashers[upload_id] = (meta['received'], hasher)
+            return meta
+    
+    def complete(self, upload_id, owner_id):
+        """
+        Verify the upload and move it into place, returns file metadata.
+        Idempotent: completing an already completed upload returns the same
+        file metadata, so a client that lost the response can simply retry.
+        """
+        if not ID_PATTERN.match(upload_id or ''):
+            raise UploadError('Upload not found', 404)
+        
+        try:
+            data_file = open(self._data_path(upload_id), 'rb')
+        except FileNotFoundError:
+            return self._completed(upload_id, owner_id)
+        
+        with data_file:
+            # Same lock as write_chunk: one completion at a time, after the last chunk
+            fcntl.flock(data_file, fcntl.LOCK_EX)
+            
+            # Re-check under the lock, a concurrent call may have finished it
+            meta = self.load(upload_id, owner_id)
+            if meta is None:
+                return self._completed(upload_id, owner_id)
+            
+            if meta['received'] != meta['size']:
+                raise UploadError('Upload is not complete', 409)
+            
+            digest = self._hasher(upload_id, meta['received']).hexdigest()
+            if meta['sha256'] and meta['sha256'] != digest:
+                self.discard(upload_id)
+                raise UploadError('Checksum mismatch, upload discarded', 422)
+            
+            file_info = {
+                'file_id': upload_id,
+                'owner_id': meta['owner_id'],
+                'recipient_id': meta['recipient_id'],
+                'filename': meta['filename'],
+                'ext': meta['ext'],
+                'kind': meta['kind'],
+                'size': meta['size'],
+                'sha256': digest
+            }
+            
+            # File first, then its metadata (the completed marker), then the session
+            os.replace(self._data_path(upload_id), self.file_path(file_info))
+            tmp_path = os.path.join(self.files_dir, f'{upload_id}.json.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(file_info, f)
+            os.replace(tmp_path, os.path.join(self.files_dir, f'{upload_id}.json'))
+            
+            self.discard(upload_id)
+            return file_info
+    
+    def _completed(self, upload_id, owner_id):
+        """File metadata of an upload that was already completed by owner_id"""
+        file_info = self.get_file(upload_id)
+        if file_info is None or file_info['owner_id'] != owner_id:
+            raise UploadError('Upload not found', 404)
+        return file_info
+    
+    def discard(self, upload_id):
+        """Remove an upload session"""
+        self._hashers.pop(upload_id, None)
+        shutil.rmtree(self._session_dir(upload_id), ignore_errors=True)
+    
+    def cleanup(self, max_age=UPLOAD_EXPIRE_SECONDS):
+        """Remove upload sessions untouched for max_age seconds"""
+        removed = 0
+        cutoff = time.time() - max_age
+        for upload_id in os.listdir(self.partial_dir):
+            meta_path = self._meta_path(upload_id)
+            try:
+                if os.path.getmtime(meta_path) < cutoff:
+                    self.discard(upload_id)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
+    
+    # Finished files
+    
+    def get_file(self, file_id):
+        """Get finished file metadata, or None"""
+        if not ID_PATTERN.match(file_id or ''):
+            return None
+        try:
+            with open(os.path.join(self.files_dir, f'{file_id}.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def file_path(self, file_info):
+        return os.path.join(self.files_dir, f"{file_info['file_id']}.{file_info['ext']}")
+    
+    # Helpers
+    
+    def _hasher(self, upload_id, received):
+        """sha256 state for the first `received` bytes (re-hashes from disk after a restart)"""
+        hashed, hasher = self._hashers.get(upload_id, (None, None))
+        if hashed != received:
+            hasher = hashlib.sha256()
+            with open(self._data_path(upload_id), 'rb') as f:
+                remaining = received
+                while remaining:
+                    block = f.read(min(READ_BUFFER_SIZE, remaining))
+                    if not block:
+                        break
+                    hasher.update(block)
+                    remaining -= len(block)
+            self._hashers[upload_id] = (received, hasher)
+        return hasher
+    
+    def _save_meta(self, meta):
+        tmp_path = self._meta_path(meta['upload_id']) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path(meta['upload_id']))
+    
+    @staticmethod
+    def _drain(stream):
+        while stream.read(READ_BUFFER_SIZE):
+            pass
+    
+    def _session_dir(self, upload_id):
+        return os.path.join(self.partial_dir, upload_id)
+    
+    def _meta_path(self, upload_id):
+        return os.path.join(self._session_dir(upload_id), 'meta.json')
+    
+    def _data_path(self, upload_id):
+        return os.path.join(self._session_dir(upload_id), 'data.part')